@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from dataplicity.app.subcommand import SubCommand
 from dataplicity.app import comms
 from dataplicity.client import Client
+from dataplicity.client.syncscheduler import SyncScheduler
 from dataplicity.client.exceptions import ForceRestart, ClientException
 from dataplicity import constants
 from dataplicity.client import settings
@@ -40,8 +41,7 @@ class Daemon(object):
                                       log=self.log)
         conf = client.conf
 
-        self.poll_rate_seconds = conf.get_float("daemon", "poll", 60.0)
-        self.last_check_time = None
+        self.scheduler = SyncScheduler.init_from_conf(client, conf)
         self.pid_path = abspath(conf.get('daemon', 'pidfile', '/var/run/dataplicity.pid'))
         self.pipe_path = abspath(conf.get('daemon', 'pipe', '/tmp/dataplicitypipe'))
 
@@ -54,6 +54,9 @@ class Daemon(object):
     def _push_wait(self, client, event, sync_func):
         client.connect_wait(event, sync_func)
 
+    def _push_sync(self):
+        self.scheduler.request('push')
+
     def exit(self, command=None):
         """Exit daemon now, and run optional command"""
         self.exit_command = command
@@ -86,7 +89,7 @@ class Daemon(object):
         sync_push_thread = Thread(target=self._push_wait,
                                   args=(self.client,
                                         self.server_closing_event,
-                                        self.sync_now))
+                                        self._push_sync))
         sync_push_thread.daemon = True
         try:
             sync_push_thread.start()
@@ -100,16 +103,13 @@ class Daemon(object):
                     except Exception as e:
                         self.log.exception('error in poll')
 
-                    start = time.time()
-                    # Loop until another poll is due, or exit is requested
-                    while time.time() - start < self.poll_rate_seconds and not self.exit_event.is_set():
-                        if pipe is not None:
-                            command = os.read(pipe, 128)
-                            if command:
-                                command = command.splitlines()[-1].rstrip('\n')
-                                self.log.debug('command pipe received {}'.format(command))
-                                success = self.on_client_command(command)
-                        self.exit_event.wait(0.1)
+                    if pipe is not None:
+                        command = os.read(pipe, 128)
+                        if command:
+                            command = command.splitlines()[-1].rstrip('\n')
+                            self.log.debug('command pipe received {}'.format(command))
+                            success = self.on_client_command(command)
+                    self.exit_event.wait(0.1)
 
             except SystemExit:
                 self.log.debug("exit requested")
@@ -136,6 +136,9 @@ class Daemon(object):
             self.log.debug("closing")
             self.server_closing_event.set()
             self.client.tasks.stop()
+            self.client.samplers.close()
+            self.client.timelines.close()
+            self.client.http.close()
             self.log.debug("goodbye")
 
             if self.exit_event.is_set() and self.exit_command is not None:
@@ -145,9 +148,19 @@ class Daemon(object):
 
 
     def poll(self, t):
-        self.sync_now(t)
+        reason = self.scheduler.get_sync_reason(t)
+        if reason is None:
+            return
+        self.log.debug('sync due ({})'.format(reason))
+        self.scheduler.start_sync()
+        success = False
+        try:
+            success = self.sync_now(t)
+        finally:
+            self.scheduler.end_sync(success)
 
     def sync_now(self, t=None):
+        """Sync immediately, returns True if the sync succeeded"""
         if t is None:
             t = time.time()
         try:
@@ -156,6 +169,8 @@ class Daemon(object):
             raise
         except Exception:
             self.log.exception('sync failed')
+            return False
+        return True
 
     def on_client_command(self, command):
         if command == 'RESTART':
@@ -170,12 +185,9 @@ class Daemon(object):
 
         elif command == "SYNC":
             self.log.info('sync requested')
-            try:
-                self.sync_now()
-            except Exception as e:
-                return self.log.exception('error on_client_command SYNC')
-            else:
-                return True
+            # Synced by the main loop, along with any other requests
+            self.scheduler.request('pipe')
+            return True
 
         elif command == "STATUS":
             self.log.info('status requested')
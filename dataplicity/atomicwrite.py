@@ -1,4 +1,8 @@
 import os
+from itertools import count
+
+# Numbers temporary files, so concurrent writes of the same file (from any thread) don't collide
+_tmp_count = count()
 
 
 class AtomicWriter(object):
@@ -7,7 +11,7 @@ class AtomicWriter(object):
     def __init__(self, path, mode='w'):
         self.path = path
         self.mode = mode
-        self.tmp_path = path + '~'
+        self.tmp_path = "{}.{}.{}~".format(path, os.getpid(), next(_tmp_count))
         self._f = None
 
     def __enter__(self):
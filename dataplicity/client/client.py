@@ -6,13 +6,15 @@ from dataplicity.client.timeline import TimelineManager
 from dataplicity.client.exceptions import ForceRestart
 from dataplicity.app import comms
 from dataplicity.jsonrpc import JSONRPC
+from dataplicity.httppool import ConnectionPool
 from dataplicity import constants
+from dataplicity import errors
 from dataplicity import firmware
 
 from fs.zipfs import ZipFS
 from fs.osfs import OSFS
 
-from urllib2 import urlopen, HTTPError
+from urllib2 import HTTPError
 from time import time, sleep
 import os
 import os.path
@@ -21,12 +23,13 @@ import random
 from base64 import b64decode
 from cStringIO import StringIO
 from threading import Lock
+from multiprocessing.pool import ThreadPool
 
 # Number of seconds to wait between failed connections
 CONNECT_WAIT = 5
 
 
-def _wait_on_url(url, closing_event, log):
+def _wait_on_url(url, closing_event, log, pool):
     """Wait for a long running http request, and respond to a closing event"""
 
     def do_wait(wait_seconds):
@@ -41,7 +44,7 @@ def _wait_on_url(url, closing_event, log):
         url_file = None
         try:
             try:
-                url_file = urlopen(url)
+                url_file = pool.open(url)
             except HTTPError as e:
                 # Server probably down or some other connectivity issue
                 log.warning("failed to connect to {} ({}), retry in {} seconds".format(url, e, CONNECT_WAIT))
@@ -101,7 +104,22 @@ class Client(object):
             self.push_url = conf.get('server',
                                      'push_url',
                                      constants.PUSH_URL)
-            self.remote = JSONRPC(self.rpc_url)
+            compress = conf.get('server', 'compress', 'none').strip().lower()
+            if compress == 'none':
+                compress = None
+            elif compress not in JSONRPC.encodings:
+                raise errors.ConfigError("[server]/compress should be none, gzip or deflate")
+            compress_level = conf.get_integer('server', 'compress_level', 6)
+            if not 1 <= compress_level <= 9:
+                raise errors.ConfigError("[server]/compress_level should be between 1 and 9")
+            keep_alive = conf.get_float('server', 'keep_alive', 60.0)
+            self.http = ConnectionPool(idle_timeout=keep_alive)
+            self.remote = JSONRPC(self.rpc_url,
+                                  compress=compress,
+                                  compress_level=compress_level,
+                                  pool=self.http,
+                                  chunked=conf.get_bool('server', 'chunked', False))
+            self.sync_workers = conf.get_integer('server', 'sync_workers', 4)
 
             self.serial = conf.get('device', 'serial', None)
             if self.serial is None:
@@ -125,6 +143,8 @@ class Client(object):
 
             self.sample_now = self.samplers.sample_now
             self.sample = self.samplers.sample
+            self.sample_many = self.samplers.sample_many
+            self.get_window = self.samplers.window
 
             self.get_timeline = self.timelines.get_timeline
         except:
@@ -146,7 +166,7 @@ class Client(object):
                 push_url = "{}?serial={}&auth={}".format(self.push_url,
                                                          self.serial,
                                                          self._auth_token)
-                response = _wait_on_url(push_url, closing_event, self.log)
+                response = _wait_on_url(push_url, closing_event, self.log, self.http)
                 if response is not None:
                     response = response.strip()
                 if response == "SYNCNOW":
@@ -240,58 +260,112 @@ class Client(object):
                 self.log.exception("unable to deploy firmware")
             raise ForceRestart("new firmware")
 
-        samplers_updated = []
         random.seed()
         sync_id = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in xrange(12))
-        with self.remote.batch() as batch:
 
-            # Authenticate
-            batch.call_with_id('authenticate_result',
-                               'device.check_auth',
-                               device_class=self.device_class,
-                               serial=self.serial,
-                               auth_token=self.auth_token,
-                               sync_id=sync_id)
-
-            # Tell the server which firmware we're running
-            batch.call_with_id('set_firmware_result',
-                               'device.set_firmware',
-                               version=self.current_firmware_version)
-
-            # Check for new firmware (if required)
-            if self.check_firmware:
-                batch.call_with_id('firmware_result',
-                                   'device.check_firmware',
-                                   current_version=self.current_firmware_version)
-
-            # Add samples
-            for sampler_name in self.samplers.enumerate_samplers():
-                sampler = self.samplers.get_sampler(sampler_name)
-                samples = sampler.snapshot_samples()
-                if samples:
-                    batch.call_with_id("samples.{}".format(sampler_name),
-                                       "device.add_samples",
-                                       device_class=self.device_class,
-                                       serial=self.serial,
-                                       sampler_name=sampler_name,
-                                       samples=samples)
-                    samplers_updated.append(sampler_name)
-                else:
-                    sampler.remove_snapshot()
-
-            # Update conf
-            conf_map = self.livesettings.contents_map
-            batch.call_with_id("conf_result",
-                               "device.update_conf_map",
-                               conf_map=conf_map)
-
-            # Update timeline(s)
-            if self.timelines:
-                for timeline in self.timelines:
-                    batch.call_with_id('timeline_result_{}'.format(timeline.name),
-                                       'device.add_events',
-                                       name=timeline.name,
-                                       events=timeline.get_events())
+        # Read rollups and timeline events in a pool of threads, so that disk reads overlap with
+        # each other and with sending the sections that are already prepared. Samples are read
+        # as they are encoded, so a large backlog is never held in memory.
+        sampler_names = self.samplers.enumerate_samplers()
+        pool = ThreadPool(max(1, self.sync_workers))
+        try:
+            rollups_jobs = [(sampler_name, pool.apply_async(self._prepare_rollups, (sampler_name,)))
+                            for sampler_name in sampler_names]
+            timeline_jobs = [(timeline, pool.apply_async(self._prepare_timeline_chunk, (timeline,)))
+                             for timeline in self.timelines]
+
+            firmware_batch = self._sync_status(sync_id, rollups_jobs)
+            self._sync_samples(sync_id, sampler_names)
+            for timeline, job in timeline_jobs:
+                self._sync_timeline(sync_id, timeline, job.get())
+                self._sync_timeline_chunks(timeline, sync_id)
+        finally:
+            pool.close()
+            pool.join()
+
+        ellapsed = time() - start
+        self.log.debug('sync complete {:0.2f}s'.format(ellapsed))
+
+        if self.check_firmware:
+            firmware_result = firmware_batch.get_result('firmware_result')
+            if firmware_result['current']:
+                self.log.debug('firmware is current')
+            else:
+                firmware_b64 = firmware_result['firmware']
+                device_class = firmware_result['device_class']
+                version = firmware_result['version']
+                self.log.debug("new firmware, version v{} for device class '{}'".format(version, device_class))
+                self.log.info("installing firmware v{}".format(version))
+                install_path = firmware.install_encoded(device_class, version, firmware_b64)
+
+                self.log.info('firmware installed in "{}"'.format(install_path))
+                comms.Comms().restart()
+
+    def _timed(self, section, func, *args):
+        """Call a function and log how long it took"""
+        start = time()
+        result = func(*args)
+        self.log.debug("{} took {:0.3f}s".format(section, time() - start))
+        return result
+
+    def _prepare_rollups(self, sampler_name):
+        sampler = self.samplers.get_sampler(sampler_name)
+        if sampler.rollups is None:
+            return None
+        return self._timed("reading rollups '{}'".format(sampler_name), sampler.rollups.snapshot)
+
+    def _prepare_timeline_chunk(self, timeline):
+        return self._timed("reading timeline '{}'".format(timeline.name), self._get_timeline_chunk, timeline)
+
+    def _check_auth(self, batch, sync_id):
+        batch.call_with_id('authenticate_result',
+                           'device.check_auth',
+                           device_class=self.device_class,
+                           serial=self.serial,
+                           auth_token=self.auth_token,
+                           sync_id=sync_id)
+
+    def _sync_status(self, sync_id, rollups_jobs):
+        """Send the first section of a sync; authentication, firmware, settings and rollups.
+
+        Returns the batch, which contains the result of the firmware check.
+
+        """
+        rollups_updated = []
+        batch = self.remote.batch()
+        self._check_auth(batch, sync_id)
+
+        # Tell the server which firmware we're running
+        batch.call_with_id('set_firmware_result',
+                           'device.set_firmware',
+                           version=self.current_firmware_version)
+
+        # Check for new firmware (if required)
+        if self.check_firmware:
+            batch.call_with_id('firmware_result',
+                               'device.check_firmware',
+                               current_version=self.current_firmware_version)
+
+        # Update conf
+        conf_map = self.livesettings.contents_map
+        batch.call_with_id("conf_result",
+                           "device.update_conf_map",
+                           conf_map=conf_map)
+
+        # Add sample rollups, so coarse data arrives even when raw samples are held back
+        for sampler_name, job in rollups_jobs:
+            rollups = job.get()
+            if rollups:
+                batch.call_with_id("rollups.{}".format(sampler_name),
+                                   "device.add_sample_rollups",
+                                   device_class=self.device_class,
+                                   serial=self.serial,
+                                   sampler_name=sampler_name,
+                                   rollups=rollups)
+                rollups_updated.append(sampler_name)
+        start = time()
+        batch.send()
+        self.log.debug("sending status took {:0.3f}s".format(time() - start))
 
         # get_result will throw exceptions with (hopefully) helpful error messages if they fail
         batch.get_result('authenticate_result')
@@ -302,17 +376,14 @@ class Client(object):
         except Exception as e:
             self.log.warning("unable to set firmware ({})".format(e))
 
-        # Remove snapshots that were successfully synced
-        # Unsuccessful snapshots remain on disk, so the next sync will re-attempt them.
-        for sampler_name in samplers_updated:
+        for sampler_name in rollups_updated:
             sampler = self.samplers.get_sampler(sampler_name)
             try:
-                if not batch.get_result("samples.{}".format(sampler_name)):
-                    self.log("failed to get sampler results '{}'".format(sampler_name))
+                batch.get_result("rollups.{}".format(sampler_name))
             except Exception as e:
-                self.log.exception("error adding samples to {} ({})".format(sampler_name, e))
+                self.log.exception("error adding rollups to {} ({})".format(sampler_name, e))
             else:
-                sampler.remove_snapshot()
+                sampler.rollups.remove_snapshot()
 
         try:
             changed_conf = batch.get_result("conf_result")
@@ -323,32 +394,104 @@ class Client(object):
                 self.livesettings.update(changed_conf, self.tasks)
                 changed_conf_names = ", ".join(sorted(changed_conf.keys()))
                 self.log.debug("settings file(s) changed: {}".format(changed_conf_names))
+        return batch
 
-        for timeline in self.timelines:
-            try:
-                timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
-            except:
-                self.log.exception('error sending timeline')
+    def _sync_samples(self, sync_id, sampler_names):
+        """Send samples, and remove the snapshots that were successfully synced"""
+        samplers_updated = []
+        batch = self.remote.batch()
+        self._check_auth(batch, sync_id)
+        for sampler_name in sampler_names:
+            sampler = self.samplers.get_sampler(sampler_name)
+            samples = sampler.snapshot_samples(sampler.sync_max_samples, lazy=True)
+            if samples:
+                batch.call_with_id("samples.{}".format(sampler_name),
+                                   "device.add_samples",
+                                   device_class=self.device_class,
+                                   serial=self.serial,
+                                   sampler_name=sampler_name,
+                                   samples=samples)
+                samplers_updated.append(sampler_name)
             else:
-                timeline.clear_events(timeline_result)
-
-        ellapsed = time() - start
-        self.log.debug('sync complete {:0.2f}s'.format(ellapsed))
+                sampler.remove_snapshot()
+        if not samplers_updated:
+            self.samplers.commit()
+            return
+        start = time()
+        batch.send()
+        self.log.debug("sending samples took {:0.3f}s".format(time() - start))
+        batch.get_result('authenticate_result')
 
-        if self.check_firmware:
-            firmware_result = batch.get_result('firmware_result')
-            if firmware_result['current']:
-                self.log.debug('firmware is current')
+        # Unsuccessful snapshots remain on disk, so the next sync will re-attempt them.
+        for sampler_name in samplers_updated:
+            sampler = self.samplers.get_sampler(sampler_name)
+            try:
+                if not batch.get_result("samples.{}".format(sampler_name)):
+                    self.log("failed to get sampler results '{}'".format(sampler_name))
+            except Exception as e:
+                self.log.exception("error adding samples to {} ({})".format(sampler_name, e))
             else:
-                firmware_b64 = firmware_result['firmware']
-                device_class = firmware_result['device_class']
-                version = firmware_result['version']
-                self.log.debug("new firmware, version v{} for device class '{}'".format(version, device_class))
-                self.log.info("installing firmware v{}".format(version))
-                install_path = firmware.install_encoded(device_class, version, firmware_b64)
+                sampler.remove_snapshot()
+        self.samplers.commit()
 
-                self.log.info('firmware installed in "{}"'.format(install_path))
-                comms.Comms().restart()
+    def _sync_timeline(self, sync_id, timeline, params):
+        """Send the first chunk of a timeline, which was read in the sync pool"""
+        if not params['events']:
+            return
+        try:
+            start = time()
+            with self.remote.batch() as batch:
+                self._check_auth(batch, sync_id)
+                self._add_timeline_chunk(batch, timeline, params)
+            self.log.debug("sending timeline '{}' took {:0.3f}s".format(timeline.name, time() - start))
+            batch.get_result('authenticate_result')
+            timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
+        except:
+            self.log.exception('error sending timeline')
+        else:
+            timeline.clear_events(timeline_result)
+
+    def _get_timeline_chunk(self, timeline):
+        """Get the parameters for device.add_events, for the next chunk of a timeline"""
+        events = timeline.get_events(inline_blobs=not timeline.upload_blobs,
+                                     limit=timeline.sync_max_events,
+                                     max_bytes=timeline.sync_max_bytes,
+                                     lazy_blobs=True)
+        params = {"name": timeline.name, "events": events}
+        if timeline.upload_blobs:
+            params['blobs'] = timeline.get_blobs(events, lazy=True)
+        return params
+
+    def _add_timeline_chunk(self, batch, timeline, params=None):
+        """Add a call to send the next chunk of a timeline to a batch"""
+        if params is None:
+            params = self._get_timeline_chunk(timeline)
+        batch.call_with_id('timeline_result_{}'.format(timeline.name),
+                           'device.add_events',
+                           **params)
+        return len(params['events'])
+
+    def _sync_timeline_chunks(self, timeline, sync_id):
+        """Send remaining timeline events in separate batches, up to the timeline's sync_chunks.
+
+        Each chunk is cleared as soon as the server has stored it, so an interrupted sync only
+        repeats the chunk in progress.
+
+        """
+        for _chunk in xrange(timeline.sync_chunks - 1):
+            if not len(timeline):
+                break
+            try:
+                with self.remote.batch() as batch:
+                    self._check_auth(batch, sync_id)
+                    event_count = self._add_timeline_chunk(batch, timeline)
+                batch.get_result('authenticate_result')
+                timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
+            except:
+                self.log.exception('error sending timeline chunk')
+                break
+            timeline.clear_events(timeline_result)
+            self.log.debug("sent {} event(s) from timeline '{}'".format(event_count, timeline.name))
 
     def deploy(self):
         """Deploy latest firmware"""
@@ -0,0 +1,272 @@
+"""
+Codecs used to serialize timeline events.
+
+Each codec has a single byte id, which is stored at the start of every record so that a timeline
+may contain records written with different codecs. Records written before codecs were introduced
+are plain JSON, and always start with '{'.
+
+"""
+
+from json import dumps, loads
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CodecError(Exception):
+    pass
+
+
+# maps codec name and id on to codec instance
+_codec_registry = {}
+_codec_ids = {}
+
+
+def register_codec(cls):
+    """Class decorator to register a codec"""
+    codec = cls()
+    _codec_registry[cls.name] = codec
+    _codec_ids[cls.codec_id] = codec
+    return cls
+
+
+def get_codec(name):
+    """Get a codec by name"""
+    try:
+        return _codec_registry[name]
+    except KeyError:
+        raise CodecError("no codec called '{}'".format(name))
+
+
+def get_codec_names():
+    return sorted(_codec_registry.keys())
+
+
+def encode_record(codec, obj):
+    """Encode an object with a codec, prefixed with the codec id"""
+    return codec.codec_id + codec.encode(obj)
+
+
+def decode_record(record):
+    """Decode a record written by `encode_record`, or a legacy JSON record"""
+    codec_id = record[:1]
+    if codec_id == b'{':
+        return loads(record)
+    try:
+        codec = _codec_ids[codec_id]
+    except KeyError:
+        raise CodecError("unknown codec id {!r}".format(codec_id))
+    return codec.decode(record[1:])
+
+
+class Codec(object):
+    """Base class for codecs"""
+
+    name = None
+    codec_id = None
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+@register_codec
+class JSONCodec(Codec):
+    """JSON without whitespace"""
+
+    name = "json"
+    codec_id = b'j'
+
+    def encode(self, obj):
+        return dumps(obj, separators=(',', ':'))
+
+    def decode(self, data):
+        return loads(data)
+
+
+@register_codec
+class ZlibCodec(Codec):
+    """zlib compressed JSON"""
+
+    name = "zlib"
+    codec_id = b'z'
+    level = 6
+
+    def encode(self, obj):
+        return zlib.compress(dumps(obj, separators=(',', ':')), self.level)
+
+    def decode(self, data):
+        return loads(zlib.decompress(data))
+
+
+_pack_double = struct.Struct(b'>d').pack
+_unpack_double = struct.Struct(b'>d').unpack_from
+
+
+def _pack_length(parts, length, fix_type, fix_limit, types):
+    """Write a type byte and length for a string, array or map"""
+    if fix_type is not None and length < fix_limit:
+        parts.append(chr(fix_type | length))
+    elif length <= 0xff and types[0] is not None:
+        parts.append(struct.pack(b'>BB', types[0], length))
+    elif length <= 0xffff:
+        parts.append(struct.pack(b'>BH', types[1], length))
+    else:
+        parts.append(struct.pack(b'>BI', types[2], length))
+
+
+def _pack(obj, parts):
+    if obj is None:
+        parts.append(b'\xc0')
+    elif obj is True:
+        parts.append(b'\xc3')
+    elif obj is False:
+        parts.append(b'\xc2')
+    elif isinstance(obj, (int, long)):
+        if 0 <= obj < 0x80:
+            parts.append(chr(obj))
+        elif -32 <= obj < 0:
+            parts.append(chr(obj & 0xff))
+        elif -0x8000000000000000 <= obj < 0x8000000000000000:
+            parts.append(struct.pack(b'>Bq', 0xd3, obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            parts.append(struct.pack(b'>BQ', 0xcf, obj))
+        else:
+            raise CodecError("integer out of range")
+    elif isinstance(obj, float):
+        parts.append(b'\xcb' + _pack_double(obj))
+    elif isinstance(obj, basestring):
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        _pack_length(parts, len(obj), 0xa0, 32, (0xd9, 0xda, 0xdb))
+        parts.append(obj)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(parts, len(obj), 0x90, 16, (None, 0xdc, 0xdd))
+        for item in obj:
+            _pack(item, parts)
+    elif isinstance(obj, dict):
+        _pack_length(parts, len(obj), 0x80, 16, (None, 0xde, 0xdf))
+        for key, value in obj.iteritems():
+            _pack(key, parts)
+            _pack(value, parts)
+    else:
+        raise CodecError("unable to encode {!r}".format(obj))
+
+
+def pack(obj):
+    """Encode an object in MessagePack format (the subset that JSON can represent)"""
+    parts = []
+    _pack(obj, parts)
+    return b''.join(parts)
+
+
+class _Unpacker(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size):
+        pos = self.pos
+        self.pos += size
+        if self.pos > len(self.data):
+            raise CodecError("unexpected end of data")
+        return self.data[pos:self.pos]
+
+    def read_struct(self, fmt):
+        size = struct.calcsize(fmt)
+        return struct.unpack(fmt, self.read(size))[0]
+
+    def read_string(self, length):
+        try:
+            return self.read(length).decode('utf-8')
+        except UnicodeDecodeError:
+            raise CodecError("invalid utf-8 in string")
+
+    def read_array(self, length):
+        return [self.unpack() for _ in xrange(length)]
+
+    def read_map(self, length):
+        obj = {}
+        for _ in xrange(length):
+            key = self.unpack()
+            obj[key] = self.unpack()
+        return obj
+
+    def unpack(self):
+        type_byte = ord(self.read(1))
+        if type_byte < 0x80:
+            return type_byte
+        if type_byte >= 0xe0:
+            return type_byte - 0x100
+        if 0xa0 <= type_byte <= 0xbf:
+            return self.read_string(type_byte & 0x1f)
+        if 0x90 <= type_byte <= 0x9f:
+            return self.read_array(type_byte & 0x0f)
+        if 0x80 <= type_byte <= 0x8f:
+            return self.read_map(type_byte & 0x0f)
+        if type_byte == 0xc0:
+            return None
+        if type_byte == 0xc2:
+            return False
+        if type_byte == 0xc3:
+            return True
+        if type_byte == 0xcb:
+            return _unpack_double(self.read(8))[0]
+        if type_byte == 0xca:
+            return self.read_struct(b'>f')
+        if type_byte in _int_formats:
+            return self.read_struct(_int_formats[type_byte])
+        if type_byte in _length_formats:
+            kind, fmt = _length_formats[type_byte]
+            length = self.read_struct(fmt)
+            if kind == 'str':
+                return self.read_string(length)
+            elif kind == 'bin':
+                return self.read(length)
+            elif kind == 'array':
+                return self.read_array(length)
+            return self.read_map(length)
+        raise CodecError("unsupported type byte 0x{:02x}".format(type_byte))
+
+
+_int_formats = {0xcc: b'>B', 0xcd: b'>H', 0xce: b'>I', 0xcf: b'>Q',
+                0xd0: b'>b', 0xd1: b'>h', 0xd2: b'>i', 0xd3: b'>q'}
+
+_length_formats = {0xd9: ('str', b'>B'), 0xda: ('str', b'>H'), 0xdb: ('str', b'>I'),
+                   0xc4: ('bin', b'>B'), 0xc5: ('bin', b'>H'), 0xc6: ('bin', b'>I'),
+                   0xdc: ('array', b'>H'), 0xdd: ('array', b'>I'),
+                   0xde: ('map', b'>H'), 0xdf: ('map', b'>I')}
+
+
+def unpack(data):
+    """Decode MessagePack data"""
+    unpacker = _Unpacker(data)
+    obj = unpacker.unpack()
+    if unpacker.pos != len(data):
+        raise CodecError("extra data after object")
+    return obj
+
+
+@register_codec
+class MsgPackCodec(Codec):
+    """Binary encoding in MessagePack format, using the msgpack module if it is installed"""
+
+    name = "msgpack"
+    codec_id = b'm'
+
+    def encode(self, obj):
+        if msgpack is not None:
+            return msgpack.packb(obj, use_bin_type=False)
+        return pack(obj)
+
+    def decode(self, data):
+        if msgpack is not None:
+            return msgpack.unpackb(data, raw=False)
+        return unpack(data)
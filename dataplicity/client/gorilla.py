@@ -0,0 +1,212 @@
+"""
+Compression for blocks of samples.
+
+Timestamps are stored as integer microseconds with delta-of-delta encoding, and values are
+stored by XORing with the previous value, as described in the Facebook Gorilla paper
+("Gorilla: A Fast, Scalable, In-Memory Time Series Database"). Regularly spaced samples of
+slowly changing values compress to a few bits per sample.
+
+A block is a struct header (sample count, payload size) followed by the bit packed payload.
+Every block is self contained, so blocks may be decoded (or discarded) independently.
+
+"""
+
+import struct
+
+
+class GorillaError(Exception):
+    pass
+
+
+block_header_struct = struct.Struct(b'<II')
+
+_double_struct = struct.Struct(b'<d')
+_uint64_struct = struct.Struct(b'<Q')
+
+# Delta-of-delta buckets; (control bits, number of control bits, number of value bits)
+_DOD_BUCKETS = [(0b10, 2, 7),
+                (0b110, 3, 9),
+                (0b1110, 4, 12),
+                (0b11110, 5, 20)]
+
+
+def _double_to_bits(value):
+    return _uint64_struct.unpack(_double_struct.pack(value))[0]
+
+
+def _bits_to_double(bits):
+    return _double_struct.unpack(_uint64_struct.pack(bits))[0]
+
+
+def _leading_zeros(value):
+    return 64 - value.bit_length()
+
+
+def _trailing_zeros(value):
+    return (value & -value).bit_length() - 1
+
+
+class BitWriter(object):
+    """Accumulates values of arbitrary bit widths in to bytes"""
+
+    def __init__(self):
+        self._bytes = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value, bit_count):
+        self._acc = (self._acc << bit_count) | value
+        self._bits += bit_count
+        while self._bits >= 8:
+            self._bits -= 8
+            self._bytes.append((self._acc >> self._bits) & 0xff)
+        self._acc &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        data = self._bytes[:]
+        if self._bits:
+            data.append((self._acc << (8 - self._bits)) & 0xff)
+        return bytes(data)
+
+
+class BitReader(object):
+    """Reads values of arbitrary bit widths from bytes"""
+
+    def __init__(self, data):
+        self._data = bytearray(data)
+        self._pos = 0
+        self._acc = 0
+        self._bits = 0
+
+    def read(self, bit_count):
+        while self._bits < bit_count:
+            try:
+                self._acc = (self._acc << 8) | self._data[self._pos]
+            except IndexError:
+                raise GorillaError("unexpected end of block")
+            self._pos += 1
+            self._bits += 8
+        self._bits -= bit_count
+        value = self._acc >> self._bits
+        self._acc &= (1 << self._bits) - 1
+        return value
+
+
+def encode_block(flat):
+    """Encode a flat sequence of alternating timestamps and values in to a block"""
+    count = len(flat) // 2
+    writer = BitWriter()
+    write = writer.write
+    prev_time = prev_delta = prev_bits = 0
+    prev_leading = prev_trailing = None
+    for index in xrange(count):
+        timestamp = int(round(flat[index * 2] * 1000000.0))
+        bits = _double_to_bits(flat[index * 2 + 1])
+        if not index:
+            write(timestamp & 0xffffffffffffffff, 64)
+            write(bits, 64)
+        else:
+            delta = timestamp - prev_time
+            dod = delta - prev_delta
+            prev_delta = delta
+            if not dod:
+                write(0, 1)
+            else:
+                for control, control_bits, value_bits in _DOD_BUCKETS:
+                    if -(1 << (value_bits - 1)) <= dod < (1 << (value_bits - 1)):
+                        write(control, control_bits)
+                        write(dod & ((1 << value_bits) - 1), value_bits)
+                        break
+                else:
+                    write(0b11111, 5)
+                    write(dod & 0xffffffffffffffff, 64)
+
+            xor = bits ^ prev_bits
+            if not xor:
+                write(0, 1)
+            else:
+                leading = min(_leading_zeros(xor), 31)
+                trailing = _trailing_zeros(xor)
+                if prev_leading is not None and leading >= prev_leading and trailing >= prev_trailing:
+                    # Meaningful bits fit within the previous window
+                    write(0b10, 2)
+                    write(xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+                else:
+                    significant = 64 - leading - trailing
+                    write(0b11, 2)
+                    write(leading, 5)
+                    write(significant & 0x3f, 6)
+                    write(xor >> trailing, significant)
+                    prev_leading, prev_trailing = leading, trailing
+        prev_time = timestamp
+        prev_bits = bits
+    payload = writer.getvalue()
+    return block_header_struct.pack(count, len(payload)) + payload
+
+
+def _signed(value, bit_count):
+    if value >= 1 << (bit_count - 1):
+        value -= 1 << bit_count
+    return value
+
+
+def decode_payload(payload, count):
+    """Decode a block payload in to a flat list of alternating timestamps and values"""
+    flat = [None] * (count * 2)
+    if not count:
+        return flat
+    reader = BitReader(payload)
+    read = reader.read
+    timestamp = _signed(read(64), 64)
+    bits = read(64)
+    flat[0] = timestamp / 1000000.0
+    flat[1] = _bits_to_double(bits)
+    delta = 0
+    leading = trailing = 0
+    for index in xrange(1, count):
+        if read(1):
+            for control_bits in (2, 3, 4, 5):
+                if control_bits == 5 or not read(1):
+                    break
+            if control_bits == 5 and read(1):
+                dod = _signed(read(64), 64)
+            else:
+                value_bits = _DOD_BUCKETS[control_bits - 2][2]
+                dod = _signed(read(value_bits), value_bits)
+            delta += dod
+        timestamp += delta
+
+        if read(1):
+            if read(1):
+                leading = read(5)
+                significant = read(6) or 64
+                trailing = 64 - leading - significant
+            bits ^= read(64 - leading - trailing) << trailing
+        flat[index * 2] = timestamp / 1000000.0
+        flat[index * 2 + 1] = _bits_to_double(bits)
+    return flat
+
+
+def iter_blocks(data):
+    """Iterate over the blocks in `data`, yielding (offset, size, count, payload).
+
+    A truncated block at the end of `data` (from an interrupted write) is ignored.
+
+    """
+    offset = 0
+    header_size = block_header_struct.size
+    while offset + header_size <= len(data):
+        count, payload_size = block_header_struct.unpack_from(data, offset)
+        size = header_size + payload_size
+        if offset + size > len(data):
+            break
+        yield offset, size, count, data[offset + header_size:offset + size]
+        offset += size
+
+
+def decode_blocks(data):
+    """Decode consecutive blocks in to a flat list of alternating timestamps and values"""
+    flat = []
+    for _offset, _size, count, payload in iter_blocks(data):
+        flat.extend(decode_payload(payload, count))
+    return flat
@@ -0,0 +1,116 @@
+"""
+Processes images for timeline events in background threads.
+
+Images may be resized, recompressed as JPEG, and have a thumbnail generated. Processing requires
+PIL (or Pillow); without it images are stored unmodified, but are still written off the
+calling thread.
+
+"""
+
+from io import BytesIO
+from threading import Thread
+from Queue import Queue
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+def parse_size(size):
+    """Parse a size in the form WIDTHxHEIGHT in to a tuple of integers"""
+    try:
+        width, height = [int(value) for value in size.lower().split('x')]
+    except ValueError:
+        raise ValueError("size must be in the form WIDTHxHEIGHT, e.g. 640x480")
+    return width, height
+
+
+class ImagePipeline(object):
+    """A bounded pool of worker threads that process images, then write their events"""
+
+    def __init__(self, workers=1, queue_size=8, max_size=None, quality=None, thumbnail_size=None):
+        self.max_size = max_size
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        # Submitting blocks when the queue is full, which limits the images held in memory
+        self._queue = Queue(maxsize=queue_size)
+        if Image is None and (max_size or quality or thumbnail_size):
+            log.warning("PIL is not installed, images will not be processed")
+        self._workers = []
+        for worker_no in xrange(max(1, workers)):
+            worker = Thread(target=self._run, name="image worker {}".format(worker_no))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, event):
+        """Queue an image event to be processed and written"""
+        self._queue.put(event)
+
+    def close(self):
+        """Process queued images and stop the worker threads"""
+        for _worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        del self._workers[:]
+
+    def _run(self):
+        while 1:
+            event = self._queue.get()
+            if event is None:
+                break
+            try:
+                self._process_event(event)
+            except Exception:
+                log.exception("error writing image event {!r}".format(event))
+
+    def _process_event(self, event):
+        data, filename, ext = event.pop_image()
+        thumbnail = None
+        if Image is not None and (self.max_size or self.quality or self.thumbnail_size):
+            try:
+                processed, thumbnail = self.process(data)
+            except Exception:
+                # Store the original rather than lose the event
+                log.exception("unable to process image for {!r}".format(event))
+            else:
+                # The original keeps its extension if it was passed through unchanged
+                if processed is not data:
+                    data = processed
+                    ext = 'jpeg'
+        event.attach_bytes(data, name='photo', filename=filename, ext=ext)
+        if thumbnail is not None:
+            event.attach_bytes(thumbnail, name='thumbnail', ext='jpeg')
+        event.write()
+
+    def _encode_jpeg(self, image):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        f = BytesIO()
+        image.save(f, 'JPEG', quality=self.quality or 85)
+        return f.getvalue()
+
+    def process(self, data):
+        """Resize and recompress image data, return a tuple of image data and thumbnail data (or None).
+
+        The image data is JPEG, or the original `data` if it didn't need to be resized or recompressed.
+
+        """
+        image = Image.open(BytesIO(data))
+        image.load()
+        thumbnail = None
+        if self.thumbnail_size:
+            thumbnail_image = image.copy()
+            thumbnail_image.thumbnail(self.thumbnail_size, Image.ANTIALIAS)
+            thumbnail = self._encode_jpeg(thumbnail_image)
+        if self.max_size and (image.size[0] > self.max_size[0] or image.size[1] > self.max_size[1]):
+            image.thumbnail(self.max_size, Image.ANTIALIAS)
+        elif not self.quality:
+            # Nothing to do, so avoid recompressing
+            return data, thumbnail
+        return self._encode_jpeg(image), thumbnail
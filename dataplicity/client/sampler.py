@@ -1,11 +1,27 @@
 from dataplicity import errors
+from dataplicity import atomicwrite
+from dataplicity.client import gorilla
 
 from time import time
 import os
+import sys
 from os.path import join, getsize, abspath, dirname, exists
-from functools import partial
-from threading import RLock
+from threading import RLock, Thread, Event
+from itertools import chain, izip
+from array import array
+from bisect import bisect_left
+from math import sqrt
+import mmap
 import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+log = logging.getLogger('dataplicity')
 
 
 class SamplerError(Exception):
@@ -16,10 +32,94 @@ class NoSamplerError(KeyError):
     pass
 
 
+def _interleave(samples, values=None):
+    """Get a flat list of alternating timestamps and values.
+
+    `samples` may be a sequence of (timestamp, value) pairs, or if `values` is given, a sequence of
+    timestamps to pair with `values`. Sequences may also be `array` or NumPy arrays.
+
+    """
+    if values is None:
+        if hasattr(samples, 'tolist'):
+            samples = samples.tolist()
+        return list(chain.from_iterable(samples))
+    timestamps = samples.tolist() if hasattr(samples, 'tolist') else list(samples)
+    values = values.tolist() if hasattr(values, 'tolist') else list(values)
+    if len(timestamps) != len(values):
+        raise ValueError("timestamps and values must be the same length")
+    flat = [None] * (len(timestamps) * 2)
+    flat[0::2] = timestamps
+    flat[1::2] = values
+    return flat
+
+
+def _decode_flat(sample_format, data):
+    """Unpack packed samples in to a flat tuple of alternating timestamps and values"""
+    sample_size = struct.calcsize(sample_format)
+    count = len(data) // sample_size
+    # Ignore any partially written sample at the end
+    data = data[:count * sample_size]
+    return struct.unpack(b'<' + sample_format.lstrip(b'<') * count, data)
+
+
+def _unpack_file_data(version, sample_format, data):
+    """Convert the body of a samples file in any format to packed samples"""
+    if version == CompressedSampler.version:
+        flat = gorilla.decode_blocks(data)
+        return struct.pack(b'<' + sample_format.lstrip(b'<') * (len(flat) // 2), *flat)
+    return data
+
+
+def _decode_samples(sample_format, data):
+    """Decode packed samples in to a list of (timestamp, value) tuples"""
+    flat = _decode_flat(sample_format, data)
+    return zip(flat[0::2], flat[1::2])
+
+
+def _make_column(typecode, items):
+    """Make an array for a column, or a list if the struct type has no equivalent array type"""
+    try:
+        return array(typecode, items)
+    except (ValueError, TypeError):
+        return list(items)
+
+
+def _decode_columns(sample_format, data, use_numpy=False):
+    """Decode packed samples in to a tuple of two columns; timestamps and values.
+
+    Columns are `array` objects, or NumPy arrays (views on the data) if `use_numpy` is True
+    and NumPy is installed.
+
+    """
+    time_format, value_format = sample_format.lstrip(b'<')
+    sample_size = struct.calcsize(sample_format)
+    data = data[:(len(data) // sample_size) * sample_size]
+    if use_numpy and numpy is not None:
+        dtype = numpy.dtype([('timestamp', '<' + time_format), ('value', '<' + value_format)])
+        samples = numpy.frombuffer(data, dtype=dtype)
+        return samples['timestamp'], samples['value']
+    if time_format == value_format:
+        try:
+            # Decode both columns in one operation, then split them
+            flat = array(time_format, data)
+        except (ValueError, TypeError):
+            pass
+        else:
+            if flat.itemsize * 2 == sample_size:
+                if sys.byteorder != 'little':
+                    flat.byteswap()
+                return flat[0::2], flat[1::2]
+    flat = _decode_flat(sample_format, data)
+    return _make_column(time_format, flat[0::2]), _make_column(value_format, flat[1::2])
+
+
 class SamplerManager(object):
     def __init__(self, path):
         self.path = path
         self.samplers = {}
+        self.segment_store = None
+        self._flusher_thread = None
+        self._flusher_stop = Event()
 
     def get_sampler(self, sampler_name):
         """Get a named sampler"""
@@ -34,6 +134,17 @@ class SamplerManager(object):
 
         samplers_path = conf.get('samplers', 'path', '/tmp/dataplicity/samplers/')
         sampler_manager = cls(samplers_path)
+        # Flush intervals of the samplers (and store), so buffered samples are written when sampling stops
+        flush_intervals = []
+        store_type = conf.get('samplers', 'store', 'files')
+        if store_type == 'segments':
+            store_path = join(dirname(conf.path), samplers_path, client.device_class, 'segments')
+            sampler_manager.segment_store = SegmentStore(store_path,
+                                                         flush_samples=conf.get_integer('samplers', 'flush_samples', 1),
+                                                         flush_interval=conf.get_float('samplers', 'flush_interval', 0.0))
+            flush_intervals.append(sampler_manager.segment_store.flush_interval)
+        elif store_type != 'files':
+            raise errors.ConfigError("[samplers]/store must be files or segments")
 
         for section, name in conf.qualified_sections('sampler'):
             if not conf.get_bool(section, 'enabled', True):
@@ -41,6 +152,46 @@ class SamplerManager(object):
             time_format = conf.get(section, 'time_format', 'd')
             value_format = conf.get(section, 'value_format', 'd')
             max_samples = conf.get_integer(section, 'max_sample', 10000)
+            storage = conf.get(section, 'storage', 'file')
+            file_format = conf.get(section, 'format', 'v1')
+            # Compressed samplers write a block per flush, so buffer enough samples to fill one
+            default_flush_samples = CompressedSampler.min_block_samples if file_format == 'v2' else 1
+            flush_samples = conf.get_integer(section, 'flush_samples', default_flush_samples)
+            flush_interval = conf.get_float(section, 'flush_interval', 0.0)
+            rollup_periods = conf.get_list(section, 'rollups', None)
+            if rollup_periods is not None:
+                try:
+                    rollup_periods = [int(period) for period in rollup_periods]
+                except ValueError:
+                    raise errors.ConfigError("[{}]/rollups must be a list of periods in seconds".format(section))
+            window_samples = conf.get_integer(section, 'window', 0)
+            sync_max_samples = conf.get(section, 'sync_max_samples', None)
+            if sync_max_samples is not None:
+                sync_max_samples = conf.get_integer(section, 'sync_max_samples')
+            if sampler_manager.segment_store is not None:
+                if storage != 'file' or file_format != 'v1' or (time_format, value_format) != ('d', 'd'):
+                    raise errors.ConfigError("[{}] storage, format and time/value formats can't be set with [samplers]/store = segments".format(section))
+                sampler = SegmentSampler(sampler_manager.segment_store,
+                                         name,
+                                         max_samples=max_samples,
+                                         rollup_periods=rollup_periods,
+                                         window_samples=window_samples)
+                sampler.sync_max_samples = sync_max_samples
+                sampler_manager.add_sampler(name, sampler)
+                client.log.debug("initialized sampler '{}' in segment store".format(name))
+                continue
+            try:
+                sampler_cls = _storage_registry[storage]
+            except KeyError:
+                raise errors.ConfigError("[{}]/storage must be one of {}".format(section, ", ".join(sorted(_storage_registry))))
+            if file_format == 'v2':
+                if storage != 'file':
+                    raise errors.ConfigError("[{}]/format v2 requires file storage".format(section))
+                if (time_format, value_format) != ('d', 'd'):
+                    raise errors.ConfigError("[{}]/format v2 requires 'd' time and value formats".format(section))
+                sampler_cls = CompressedSampler
+            elif file_format != 'v1':
+                raise errors.ConfigError("[{}]/format must be v1 or v2".format(section))
             path = join(dirname(conf.path), samplers_path, client.device_class, name)
             try:
                 os.makedirs(path)
@@ -49,13 +200,32 @@ class SamplerManager(object):
             else:
                 client.log.debug("created {}".format(path))
 
-            sampler = Sampler(path,
-                              name,
-                              time_format=time_format,
-                              value_format=value_format,
-                              max_samples=max_samples)
+            sampler = sampler_cls(path,
+                                  name,
+                                  time_format=time_format,
+                                  value_format=value_format,
+                                  max_samples=max_samples,
+                                  flush_samples=flush_samples,
+                                  flush_interval=flush_interval,
+                                  rollup_periods=rollup_periods,
+                                  window_samples=window_samples)
+            sampler.sync_max_samples = sync_max_samples
             sampler_manager.add_sampler(name, sampler)
+            flush_intervals.append(flush_interval)
             client.log.debug("initialized sampler '{}'".format(name))
+
+        if sampler_manager.segment_store is not None:
+            # Fill the windows with a single pass over the segments
+            window_samplers = [window_sampler for window_sampler in sampler_manager.samplers.itervalues()
+                               if window_sampler.window is not None]
+            if window_samplers:
+                series = sampler_manager.segment_store.read_series([sampler.series_id for sampler in window_samplers])
+                for sampler in window_samplers:
+                    sampler.window.add_many(series[sampler.series_id][-sampler.window.capacity * 2:])
+
+        flush_intervals = [interval for interval in flush_intervals if interval > 0]
+        if flush_intervals:
+            sampler_manager.start_flusher(min(flush_intervals) / 2.0)
         return sampler_manager
 
     def add_sampler(self, name, sampler):
@@ -72,21 +242,405 @@ class SamplerManager(object):
         """Add a sample to the given sampler, with the current time"""
         self.get_sampler(sampler_name).add_sample(time(), value)
 
+    def sample_many(self, sampler_name, samples, values=None):
+        """Add many samples to the given sampler, return the number of samples accepted"""
+        return self.get_sampler(sampler_name).add_samples(samples, values)
+
+    def _get_window(self, sampler_name):
+        window = self.get_sampler(sampler_name).window
+        if window is None:
+            raise SamplerError("sampler '{}' has no window, set [sampler:{}]/window".format(sampler_name, sampler_name))
+        return window
+
+    def window(self, sampler_name, seconds=None, count=None, use_numpy=False):
+        """Get the most recent samples from memory, as a tuple of arrays (timestamps, values).
+
+        `seconds` limits the samples to those within the last number of seconds, and `count`
+        limits the number of samples returned.
+
+        """
+        return self._get_window(sampler_name).get(seconds=seconds, count=count, use_numpy=use_numpy)
+
+    def window_stats(self, sampler_name):
+        """Get running statistics for the samples in a sampler's window"""
+        return self._get_window(sampler_name).stats()
+
     def enumerate_samplers(self):
         """Get the names of all the samplers"""
         return sorted(self.samplers.keys())
 
+    def flush(self):
+        """Write any buffered samples to disk"""
+        for sampler in self.samplers.itervalues():
+            sampler.flush()
+
+    def flush_if_due(self):
+        """Write buffered samples that have been held for longer than their flush interval"""
+        for sampler in self.samplers.itervalues():
+            sampler.flush_if_due()
+
+    def start_flusher(self, interval):
+        """Start a background thread that calls `flush_if_due` every `interval` seconds"""
+        if self._flusher_thread is not None:
+            return
+        self._flusher_stop.clear()
+        self._flusher_thread = Thread(target=self._run_flusher,
+                                      args=(interval,),
+                                      name="sampler flusher")
+        self._flusher_thread.daemon = True
+        self._flusher_thread.start()
+
+    def _run_flusher(self, interval):
+        while not self._flusher_stop.wait(interval):
+            try:
+                self.flush_if_due()
+            except Exception:
+                log.exception("error flushing samplers")
+
+    def commit(self):
+        """Persist acknowledgements made during a sync, and reclaim storage"""
+        if self.segment_store is not None:
+            self.segment_store.commit()
+
+    def close(self):
+        """Stop the flusher, then flush and close all samplers"""
+        if self._flusher_thread is not None:
+            self._flusher_stop.set()
+            self._flusher_thread.join()
+            self._flusher_thread = None
+        for sampler in self.samplers.itervalues():
+            sampler.close()
+        if self.segment_store is not None:
+            self.segment_store.close()
+
+
+class Rollups(object):
+    """Incrementally updated summaries (count, mean, min and max) of samples over fixed periods.
+
+    The summary for the current period of each tier is kept in memory, and written to the
+    rollups file when a sample arrives for a later period. A summary may be written more than once
+    for the same period (if the device restarts part way through a period, for example), but the
+    count and mean allow them to be merged.
+
+    """
+
+    header = "rollups v1\n"
+    record_struct = struct.Struct(b'<IdIddd')
+
+    def __init__(self, path, periods):
+        self.path = path
+        self.periods = sorted(periods)
+        # Maps period on to the summary in progress [start, count, total, min, max]
+        self._summaries = {}
+        self._snapshot_size = None
+        self.lock = RLock()
+        if not exists(self.path):
+            with open(self.path, 'wb') as f:
+                f.write(self.header)
+
+    def add(self, timestamp, value):
+        """Add a sample to the rollups"""
+        with self.lock:
+            for period in self.periods:
+                start = timestamp - timestamp % period
+                summary = self._summaries.get(period)
+                if summary is None or start > summary[0]:
+                    if summary is not None:
+                        self._write(period, summary)
+                    self._summaries[period] = [start, 1, value, value, value]
+                elif start == summary[0]:
+                    summary[1] += 1
+                    summary[2] += value
+                    if value < summary[3]:
+                        summary[3] = value
+                    if value > summary[4]:
+                        summary[4] = value
+                else:
+                    # A sample older than the current period is summarized on its own
+                    self._write(period, [start, 1, value, value, value])
+
+    def add_many(self, flat):
+        """Add samples from a flat sequence of alternating timestamps and values"""
+        add = self.add
+        with self.lock:
+            for timestamp, value in izip(flat[0::2], flat[1::2]):
+                add(timestamp, value)
+
+    def _write(self, period, summary):
+        with open(self.path, 'ab') as f:
+            f.write(self.record_struct.pack(period, *summary))
+
+    def close(self):
+        """Write the summaries in progress, so they aren't lost"""
+        with self.lock:
+            for period, summary in sorted(self._summaries.items()):
+                self._write(period, summary)
+            self._summaries.clear()
+
+    def _read_data(self):
+        with open(self.path, 'rb') as f:
+            f.readline()
+            data = f.read()
+        return data[:len(data) - len(data) % self.record_struct.size]
+
+    def snapshot(self):
+        """Get completed summaries for syncing.
+
+        Returns a dict that maps the period on to a list of [start, count, mean, min, max].
+
+        """
+        with self.lock:
+            data = self._read_data()
+            self._snapshot_size = len(data)
+        rollups = {}
+        unpack_from = self.record_struct.unpack_from
+        for offset in xrange(0, len(data), self.record_struct.size):
+            period, start, count, total, min_value, max_value = unpack_from(data, offset)
+            rollups.setdefault(str(period), []).append([start, count, float(total) / count, min_value, max_value])
+        return rollups
+
+    def remove_snapshot(self):
+        """Remove summaries in the last snapshot, once they have been synced"""
+        with self.lock:
+            if self._snapshot_size is None:
+                return
+            data = self._read_data()[self._snapshot_size:]
+            with atomicwrite.open(self.path, 'wb') as f:
+                f.write(self.header)
+                f.write(data)
+            self._snapshot_size = None
+
+
+class SampleWindow(object):
+    """A bounded, in-memory window of the most recent samples.
+
+    Samples are stored in a pair of arrays used as a circular buffer. A running total and total
+    of squares are kept, so the mean and standard deviation are available without a rescan.
+
+    """
+
+    def __init__(self, capacity, lock=None):
+        self.capacity = capacity
+        self.lock = lock or RLock()
+        self._timestamps = array('d')
+        self._values = array('d')
+        # Index of the oldest sample, once the buffer is full
+        self._start = 0
+        self._total = 0.0
+        self._total_squares = 0.0
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, timestamp, value):
+        with self.lock:
+            value = float(value)
+            if len(self._values) < self.capacity:
+                self._timestamps.append(timestamp)
+                self._values.append(value)
+            else:
+                start = self._start
+                old_value = self._values[start]
+                self._total -= old_value
+                self._total_squares -= old_value * old_value
+                self._timestamps[start] = timestamp
+                self._values[start] = value
+                self._start = start = (start + 1) % self.capacity
+                if not start:
+                    # Recalculate the totals periodically, so rounding errors don't accumulate
+                    self._total = sum(self._values) - value
+                    self._total_squares = sum(v * v for v in self._values) - value * value
+            self._total += value
+            self._total_squares += value * value
+
+    def add_many(self, flat):
+        """Add samples from a flat sequence of alternating timestamps and values"""
+        add = self.add
+        with self.lock:
+            for timestamp, value in izip(flat[0::2], flat[1::2]):
+                add(timestamp, value)
+
+    def get(self, seconds=None, count=None, use_numpy=False):
+        """Get a copy of the window as a tuple of arrays (timestamps, values), oldest first"""
+        with self.lock:
+            start = self._start
+            timestamps = self._timestamps[start:] + self._timestamps[:start]
+            values = self._values[start:] + self._values[:start]
+        first = 0
+        if seconds is not None:
+            first = bisect_left(timestamps, time() - seconds)
+        if count is not None:
+            first = max(first, len(values) - count)
+        if first:
+            timestamps = timestamps[first:]
+            values = values[first:]
+        if use_numpy and numpy is not None:
+            return numpy.frombuffer(timestamps, dtype=numpy.float64), numpy.frombuffer(values, dtype=numpy.float64)
+        return timestamps, values
+
+    def stats(self):
+        """Get a dict of statistics for the samples in the window"""
+        with self.lock:
+            count = len(self._values)
+            if not count:
+                return {"count": 0, "mean": None, "stddev": None, "min": None, "max": None}
+            mean = self._total / count
+            variance = max(0.0, self._total_squares / count - mean * mean)
+            return {"count": count,
+                    "mean": mean,
+                    "stddev": sqrt(variance),
+                    "min": min(self._values),
+                    "max": max(self._values)}
+
+
+class BlockIndex(object):
+    """An index of the blocks of samples in a samples file, stored alongside the samples file.
+
+    Each entry is a tuple of (start offset, end offset, sample count, minimum timestamp,
+    maximum timestamp, CRC32 of the block). Entries are contiguous, and ordered by offset.
+
+    """
+
+    header = "sampler index v1\n"
+    entry_struct = struct.Struct(b'<QQIddI')
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        # Running maximum of the maximum timestamps, which may be searched with bisect
+        self._max_times = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """Load entries from the index file, return False if the index file is missing or damaged"""
+        self.clear()
+        try:
+            with open(self.path, 'rb') as f:
+                if f.readline() != self.header:
+                    return False
+                data = f.read()
+        except IOError:
+            return False
+        entry_size = self.entry_struct.size
+        unpack_from = self.entry_struct.unpack_from
+        self._add([unpack_from(data, offset)
+                   for offset in xrange(0, len(data) - len(data) % entry_size, entry_size)])
+        return True
+
+    def save(self):
+        """Rewrite the index file"""
+        with atomicwrite.open(self.path, 'wb') as f:
+            f.write(self.header)
+            f.write(b''.join(self.entry_struct.pack(*entry) for entry in self.entries))
+
+    def clear(self):
+        del self.entries[:]
+        del self._max_times[:]
+
+    def _add(self, entries):
+        max_time = self._max_times[-1] if self._max_times else float('-inf')
+        for entry in entries:
+            max_time = max(max_time, entry[4])
+            self.entries.append(entry)
+            self._max_times.append(max_time)
+
+    def append(self, entries):
+        """Add new entries, and append them to the index file"""
+        if not entries:
+            return
+        self._add(entries)
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(self.entry_struct.pack(*entry) for entry in entries))
+
+    def prune(self, offset):
+        """Remove entries for blocks that end before `offset`"""
+        entries = [entry for entry in self.entries if entry[1] > offset]
+        self.clear()
+        self._add(entries)
+
+    def find(self, start_time, end_time):
+        """Get entries for blocks that may contain samples between two timestamps (inclusive)"""
+        # Blocks before the first block with a (running) maximum timestamp >= start_time
+        # can't contain any samples in the range
+        first = bisect_left(self._max_times, start_time)
+        return [entry for entry in self.entries[first:]
+                if entry[3] <= end_time and entry[4] >= start_time]
+
+    def floor(self, offset):
+        """Get the offset of the start of the block containing `offset`, or None if not indexed"""
+        for entry in reversed(self.entries):
+            if entry[0] <= offset:
+                return entry[0] if offset < entry[1] else None
+        return None
+
 
 class Sampler(object):
-    def __init__(self, path, name, time_format='d', value_format='d', max_samples=1000):
+    """A sampler that appends samples to a file.
+
+    Samples are buffered in memory and written to a persistent file handle every `flush_samples`
+    samples, or when `flush_interval` seconds have elapsed since the last write. The default of
+    flushing every sample writes through immediately.
+
+    Syncing is tracked with offsets, which count the bytes of sample data ever written to the
+    sampler. The offset the server has acknowledged is persisted in a cursor file, along with the
+    offset of the first sample remaining in the samples file. Acknowledged samples are discarded
+    by truncating or compacting the samples file.
+
+    Samples are indexed in blocks of `index_block_samples`, so that `read_range` and `read_last`
+    need only decode the blocks they require. The block at the end of the file is indexed once
+    it is complete.
+
+    """
+
+    version = "sampler v1"
+    index_block_samples = 256
+
+    def __init__(self,
+                 path,
+                 name,
+                 time_format='d',
+                 value_format='d',
+                 max_samples=1000,
+                 flush_samples=1,
+                 flush_interval=0.0,
+                 rollup_periods=None,
+                 window_samples=0):
         self.path = abspath(path)
         self.name = name
         self.time_format = time_format
         self.value_format = value_format
         self.max_samples = max_samples
+        self.flush_samples = max(1, flush_samples)
+        self.flush_interval = flush_interval
+        # Maximum number of raw samples to send per sync, or None for no limit
+        self.sync_max_samples = None
+
+        self._file = None
+        self._buffer = []
+        self._buffered_count = 0
+        self._sample_count = 0
+        self._last_flush_time = time()
 
         self.samples_path = join(path, 'samples.smp')
+        self.samples_cursor_path = join(path, 'samples.cursor')
+        self.index = BlockIndex(join(path, 'samples.idx'))
+        # The block at the end of the file which isn't yet indexed [start offset, count, min, max, crc]
+        self._index_block = None
+        # Snapshots were written by previous versions, and are migrated on startup
         self.samples_snapshot_path = join(path, 'samples.smp.snapshot')
+        # Written if the sampler previously had ring storage
+        self.samples_ring_path = join(path, 'samples.ring')
+
+        # Offset of the first sample in the samples file
+        self._origin_offset = 0
+        # Offset acknowledged by the server
+        self._cursor_offset = 0
+        # Offset of the end of the samples file
+        self._end_offset = 0
+        # Offset at the end of the last snapshot
+        self._snapshot_offset = None
 
         sample_format = self.sample_format = b'<' + time_format + value_format
         sample_struct = self.sample_struct = struct.Struct(sample_format)
@@ -98,85 +652,1466 @@ class Sampler(object):
 
         self.lock = RLock()
 
+        if rollup_periods:
+            self.rollups = Rollups(join(path, 'rollups.smr'), rollup_periods)
+        else:
+            self.rollups = None
+
+        if window_samples:
+            self.window = SampleWindow(window_samples, lock=self.lock)
+        else:
+            self.window = None
+
         self.check_create()
+        if self.window is not None:
+            # Start with the most recent samples on disk
+            self.window.add_many(_interleave(self.read_last(window_samples)))
         super(Sampler, self).__init__()
 
     @property
     def header(self):
-        """Header is text based, the rest of the file is binary. No validation is done at the moment,
-        but this format is future proofed for expansion."""
-        return "sampler v1\n" + self.sample_format + '\n'
+        """Header is text based, the rest of the file is binary. The first line contains the
+        version of the file format, the second line contains the struct format of a sample."""
+        return self.version + "\n" + self.sample_format + '\n'
 
     @classmethod
     def _read_header(self, f):
         """Read the sampler header from a file object"""
-        f.readline()  # First line reserved for expansion
+        f.readline()  # First line contains the version
         # Second line contains struct format
         return f.readline().rstrip('\n')
 
+    @classmethod
+    def _read_file(cls, samples_path):
+        """Read the version, sample format, and the (undecoded) body of a samples file"""
+        with open(samples_path, 'rb') as f:
+            version = f.readline().rstrip('\n')
+            sample_format = f.readline().rstrip('\n')
+            data = f.read()
+        return version, sample_format, data
+
     @property
     def full(self):
         """Check if the sampler has more than the maximum number of samples"""
-        return getsize(self.samples_path) >= self.max_file_size
+        return self._sample_count >= self.max_samples
+
+    @property
+    def pending(self):
+        """The number of samples waiting to be synced"""
+        return self._sample_count
 
     def check_create(self):
         """Create an empty sampler if it doesn't already exist"""
         with self.lock:
+            if exists(self.samples_ring_path):
+                self._migrate_ring()
             if not exists(self.samples_path):
                 with open(self.samples_path, 'wb') as f:
                     f.write(self.header)
+            else:
+                with open(self.samples_path, 'rb') as f:
+                    header = f.read(len(self.header))
+                if header != self.header:
+                    self._convert_samples_file()
+            if exists(self.samples_snapshot_path):
+                self._migrate_snapshot()
+            self._origin_offset, self._cursor_offset = self._read_cursor()
+            # Measure the file once, so we don't need to stat the file for every sample
+            body_size = self._measure_body()
+            if getsize(self.samples_path) != len(self.header) + body_size:
+                # Discard a partially written sample from an interrupted write
+                with open(self.samples_path, 'r+b') as f:
+                    f.truncate(len(self.header) + body_size)
+            self._end_offset = self._origin_offset + body_size
+            self._cursor_offset = min(max(self._cursor_offset, self._origin_offset), self._end_offset)
+            self._update_count()
+            self._load_index()
+
+    def _load_index(self):
+        """Load the block index, and index any samples missing from it"""
+        index = self.index
+        index.load()
+        index.prune(self._origin_offset)
+        entries = index.entries
+        contiguous = all(entry[1] == next_entry[0] for entry, next_entry in izip(entries, entries[1:]))
+        if not contiguous or (entries and (entries[0][0] != self._origin_offset or
+                                           entries[-1][1] > self._end_offset)):
+            log.warning("rebuilding sampler index {}".format(index.path))
+            index.clear()
+        index_end = entries[-1][1] if entries else self._origin_offset
+        index.save()
+        self._index_block = None
+        index.append(self._index_data(index_end, self._read_offsets(index_end, self._end_offset)))
+
+    def _index_data(self, start_offset, data, flat=None):
+        """Update the index block with data written at `start_offset`.
+
+        Returns a list of index entries for any blocks that are now complete.
+
+        """
+        if flat is None:
+            flat = _decode_flat(self.sample_format, data)
+        timestamps = flat[0::2]
+        sample_size = self.sample_size
+        block_samples = self.index_block_samples
+        entries = []
+        position = 0
+        while position < len(timestamps):
+            if self._index_block is None:
+                self._index_block = [start_offset + position * sample_size, 0, float('inf'), float('-inf'), 0]
+            block = self._index_block
+            count = min(block_samples - block[1], len(timestamps) - position)
+            block_timestamps = timestamps[position:position + count]
+            block[1] += count
+            block[2] = min(block[2], min(block_timestamps))
+            block[3] = max(block[3], max(block_timestamps))
+            block[4] = zlib.crc32(data[position * sample_size:(position + count) * sample_size], block[4])
+            position += count
+            if block[1] == block_samples:
+                block_start, block_count, min_time, max_time, crc = block
+                entries.append((block_start,
+                                block_start + block_count * sample_size,
+                                block_count,
+                                min_time,
+                                max_time,
+                                crc & 0xffffffff))
+                self._index_block = None
+        return entries
+
+    def _measure_body(self):
+        """Get the size of the complete samples in the samples file"""
+        body_size = max(0, getsize(self.samples_path) - len(self.header))
+        return body_size - body_size % self.sample_size
+
+    def _update_count(self):
+        """Update the number of samples that have yet to be acknowledged"""
+        unacked_size = self._end_offset - self._cursor_offset
+        self._sample_count = unacked_size // self.sample_size + self._buffered_count
+
+    def _migrate_snapshot(self):
+        """Move samples from a snapshot written by a previous version back in to the samples file"""
+        _, snapshot_data = self._read_data(self.samples_snapshot_path)
+        _, samples_data = self._read_data(self.samples_path)
+        self._close_file()
+        self._remove_index()
+        with atomicwrite.open(self.samples_path, 'wb') as f:
+            f.write(self.header)
+            f.write(self._encode(snapshot_data + samples_data))
+        os.remove(self.samples_snapshot_path)
+
+    def _read_unacked_file(self, samples_path):
+        """Read the samples in a samples file (in any format) that haven't been acknowledged.
+
+        Returns the sample format and the packed samples.
+
+        """
+        version, sample_format, data = self._read_file(samples_path)
+        origin_offset, cursor_offset = self._read_cursor()
+        data = data[max(0, cursor_offset - origin_offset):]
+        return sample_format, _unpack_file_data(version, sample_format, data)
+
+    def _convert_samples_file(self):
+        """Rewrite a samples file written in a different format, after the conf has changed"""
+        sample_format, data = self._read_unacked_file(self.samples_path)
+        if sample_format != self.sample_format:
+            flat = _decode_flat(sample_format, data)
+            try:
+                data = struct.pack(b'<' + self.sample_format.lstrip(b'<') * (len(flat) // 2), *flat)
+            except struct.error:
+                log.warning("unable to convert samples in {} to format {}".format(self.samples_path, self.sample_format))
+                data = b''
+        self._close_file()
+        self._remove_index()
+        self._origin_offset = self._cursor_offset = 0
+        self._write_cursor()
+        with atomicwrite.open(self.samples_path, 'wb') as f:
+            f.write(self.header)
+            f.write(self._encode(data))
+
+    def _read_ring_file(self):
+        """Read samples from a ring file (in any format or size), so they may be migrated"""
+        if not exists(self.samples_ring_path):
+            return []
+        try:
+            with open(self.samples_ring_path, 'rb') as f:
+                sample_struct = struct.Struct(self._read_header(f))
+                first_seq, next_seq = RingSampler.seq_struct.unpack(f.read(RingSampler.seq_struct.size))
+                data = f.read()
+        except (IOError, struct.error):
+            return []
+        capacity = len(data) // sample_struct.size
+        first_seq = max(first_seq, next_seq - capacity)
+        return [sample_struct.unpack_from(data, (seq % capacity) * sample_struct.size)
+                for seq in xrange(first_seq, next_seq)]
+
+    def _migrate_ring(self):
+        """Move unacknowledged samples from a ring file in to the samples file"""
+        flat = []
+        if exists(self.samples_path):
+            sample_format, data = self._read_unacked_file(self.samples_path)
+            flat.extend(_decode_flat(sample_format, data))
+        flat.extend(_interleave(self._read_ring_file()))
+        try:
+            data = struct.pack(b'<' + (self.time_format + self.value_format) * (len(flat) // 2), *flat)
+        except struct.error:
+            log.warning("unable to convert samples in {} to format {}".format(self.samples_ring_path, self.sample_format))
+            data = b''
+        self._close_file()
+        self._remove_index()
+        self._origin_offset = self._cursor_offset = 0
+        self._write_cursor()
+        with atomicwrite.open(self.samples_path, 'wb') as f:
+            f.write(self.header)
+            f.write(self._encode(data))
+        os.remove(self.samples_ring_path)
+
+    def _remove_index(self):
+        """Remove the index file, which is rebuilt when the samples file is rewritten"""
+        if exists(self.index.path):
+            os.remove(self.index.path)
+
+    def _encode(self, data):
+        """Encode packed samples for the samples file"""
+        return data
+
+    def _unpack_raw(self, data):
+        """Convert data read from the samples file to packed samples"""
+        return data
+
+    def _read_cursor(self):
+        """Read the origin and cursor offsets"""
+        try:
+            with open(self.samples_cursor_path, 'rb') as f:
+                origin_offset, cursor_offset = [int(offset) for offset in f.read().split()]
+        except (IOError, ValueError):
+            return 0, 0
+        return origin_offset, cursor_offset
+
+    def _write_cursor(self):
+        """Persist the origin and cursor offsets"""
+        with atomicwrite.open(self.samples_cursor_path, 'wb') as f:
+            f.write("{} {}\n".format(self._origin_offset, self._cursor_offset))
+
+    def _get_file_position(self, offset):
+        """Get the position in the samples file of a given offset"""
+        return len(self.header) + offset - self._origin_offset
+
+    def _open(self):
+        """Get the persistent file handle used to append samples"""
+        if self._file is None:
+            self._file = open(self.samples_path, 'ab')
+        return self._file
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        """Write buffered samples to disk"""
+        with self.lock:
+            if self._buffer:
+                data = b''.join(self._buffer)
+                f = self._open()
+                f.write(data)
+                f.flush()
+                del self._buffer[:]
+                self._buffered_count = 0
+                self.index.append(self._index_data(self._end_offset, data))
+                self._end_offset += len(data)
+            self._last_flush_time = time()
+
+    def flush_if_due(self):
+        """Flush if samples are buffered and `flush_interval` seconds have elapsed since the last write"""
+        with self.lock:
+            if self._buffered_count and self.flush_interval and \
+                    time() - self._last_flush_time >= self.flush_interval:
+                self.flush()
+
+    def close(self):
+        """Flush buffered samples and close the file handle"""
+        with self.lock:
+            self.flush()
+            self._close_file()
+            if self.rollups is not None:
+                self.rollups.close()
+
+    def _read_data(self, samples_path=None):
+        """Read the sample format and the packed samples from a samples file.
+
+        If `samples_path` isn't given, only samples that haven't been acknowledged are read.
+
+        """
+        if samples_path is None:
+            with self.lock:
+                self.flush()
+                return self.sample_format, self._read_packed(self._cursor_offset, self._end_offset)
+        version, sample_format, data = self._read_file(samples_path)
+        return sample_format, _unpack_file_data(version, sample_format, data)
+
+    def _read_offsets(self, start_offset, end_offset):
+        """Read packed samples between two offsets"""
+        # N.B. Call with the lock held, so the file isn't compacted underneath us
+        if end_offset <= start_offset:
+            return b''
+        with open(self.samples_path, 'rb') as f:
+            f.seek(self._get_file_position(start_offset))
+            return f.read(end_offset - start_offset)
+
+    def _read_packed(self, start_offset, end_offset):
+        """Read samples between two offsets, as packed samples"""
+        return self._unpack_raw(self._read_offsets(start_offset, end_offset))
+
+    def _read_blocks(self, entries):
+        """Read and check indexed blocks, and the unindexed samples at the end of the file.
+
+        Returns packed samples that haven't been acknowledged. Blocks that fail the CRC check
+        are logged and skipped.
+
+        """
+        # N.B. Call with the lock held
+        cursor_offset = self._cursor_offset
+        packed = []
+        for start_offset, end_offset, _count, _min_time, _max_time, crc in entries:
+            if end_offset <= cursor_offset:
+                continue
+            data = self._read_offsets(start_offset, end_offset)
+            if zlib.crc32(data) & 0xffffffff != crc:
+                log.warning("sampler '{}' block at offset {} is corrupt".format(self.name, start_offset))
+                continue
+            data = self._unpack_raw(data)
+            if start_offset < cursor_offset:
+                # Part of the block has been acknowledged
+                data = data[cursor_offset - start_offset:]
+            packed.append(data)
+        index_end = self.index.entries[-1][1] if self.index.entries else self._origin_offset
+        packed.append(self._read_packed(max(index_end, cursor_offset), self._end_offset))
+        return b''.join(packed)
+
+    def read_range(self, start_time, end_time):
+        """Read samples with timestamps between `start_time` and `end_time` (inclusive)"""
+        with self.lock:
+            self.flush()
+            data = self._read_blocks(self.index.find(start_time, end_time))
+        return [sample for sample in _decode_samples(self.sample_format, data)
+                if start_time <= sample[0] <= end_time]
+
+    def read_last(self, count):
+        """Read the last `count` samples"""
+        if count <= 0:
+            return []
+        with self.lock:
+            self.flush()
+            cursor_offset = self._cursor_offset
+            index_end = self.index.entries[-1][1] if self.index.entries else self._origin_offset
+            found = (self._end_offset - max(index_end, cursor_offset)) // self.sample_size
+            entries = []
+            for entry in reversed(self.index.entries):
+                if found >= count or entry[1] <= cursor_offset:
+                    break
+                entries.insert(0, entry)
+                if entry[0] >= cursor_offset:
+                    found += entry[2]
+                else:
+                    found += (entry[1] - cursor_offset) // self.sample_size
+            data = self._read_blocks(entries)
+        return _decode_samples(self.sample_format, data)[-count:]
+
+    def _chunk_end(self, start_offset, max_samples=None):
+        """Get the offset at the end of a chunk of at most `max_samples` samples"""
+        if max_samples is None:
+            return self._end_offset
+        return min(self._end_offset, start_offset + max_samples * self.sample_size)
 
     def read_samples(self, samples_path=None):
         """Read and unpack all the samples in to a list of tuples (timestamp, value)"""
-        # N.B. Doesn't lock
+        return _decode_samples(*self._read_data(samples_path))
+
+    def read_columns(self, samples_path=None, use_numpy=False):
+        """Read all the samples in to two arrays; timestamps and values.
+
+        If `use_numpy` is True and NumPy is installed, NumPy arrays are returned.
+
+        """
+        sample_format, data = self._read_data(samples_path)
+        return _decode_columns(sample_format, data, use_numpy=use_numpy)
+
+    def iter_samples(self, samples_path=None, chunk_samples=1024):
+        """Lazily iterate over (timestamp, value) tuples, reading `chunk_samples` at a time"""
         if samples_path is None:
-            samples_path = self.samples_path
+            start_offset, end_offset = self._snapshot_range()
+            for sample in self._iter_range(start_offset, end_offset, chunk_samples):
+                yield sample
+            return
         with open(samples_path, 'rb') as f:
+            if f.readline().rstrip('\n') == CompressedSampler.version:
+                # Blocks must be decoded as a whole
+                for sample in self.read_samples(samples_path):
+                    yield sample
+                return
+            f.seek(0)
             sample_format = self._read_header(f)
-            sample_struct = struct.Struct(sample_format)
-            sample_size = sample_struct.size
-            read_sample = partial(f.read, sample_size)
-            unpack = sample_struct.unpack
-            samples = [unpack(sample) for sample in iter(read_sample, b'')]
-        return samples
+            chunk_size = struct.calcsize(sample_format) * chunk_samples
+            while 1:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                flat = _decode_flat(sample_format, data)
+                for sample in izip(flat[0::2], flat[1::2]):
+                    yield sample
 
     def reset(self):
         """Reset samples"""
         with self.lock:
+            self._close_file()
+            del self._buffer[:]
+            self._buffered_count = 0
             with open(self.samples_path, 'wb') as f:
                 f.write(self.header)
+            self._origin_offset = self._cursor_offset = self._end_offset
+            self._snapshot_offset = None
+            self._write_cursor()
+            self._sample_count = 0
+            self.index.clear()
+            self.index.save()
+            self._index_block = None
 
     def add_sample(self, timestamp, value):
         """Add a sample, return True if the sample was added.
         A return value of False indicates the sampler file has reached the maximum number of samples allowed.
 
         """
-        if self.full:
-            # Stop sampling when the file is full
-            return False
         with self.lock:
-            with open(self.samples_path, 'ab') as f:
-                f.write(self.sample_pack(timestamp, value))
+            # Rollups and the window are updated even when the file is full
+            self._observe(timestamp, value)
+            if self.full:
+                # Stop sampling when the file is full
+                return False
+            self._buffer.append(self.sample_pack(timestamp, value))
+            self._buffered_count += 1
+            self._sample_count += 1
+            self._check_flush()
         return True
 
-    def snapshot_samples(self):
-        """Take a snapshot of samples for syncing, so that sampling may continue uninterrupted"""
-        # A snapshot is a copy of the current samples file
-        # Once it has been synced it can be deleted
-        if not exists(self.samples_snapshot_path):
+    def add_samples(self, samples, values=None):
+        """Add many samples at once, return the number of samples added.
+
+        `samples` may be a sequence of (timestamp, value) pairs, or a sequence of timestamps with
+        a parallel sequence of `values`. If the sampler fills up, the remaining samples are
+        discarded and the return value will be less than the number of samples supplied.
+
+        """
+        flat = _interleave(samples, values)
+        with self.lock:
+            self._observe_many(flat)
+            count = min(len(flat) // 2, max(0, self.max_samples - self._sample_count))
+            if not count:
+                return 0
+            pack_format = b'<' + (self.time_format + self.value_format) * count
+            self._buffer.append(struct.pack(pack_format, *flat[:count * 2]))
+            self._buffered_count += count
+            self._sample_count += count
+            self._check_flush()
+        return count
+
+    def _observe(self, timestamp, value):
+        """Update rollups and the window with a new sample"""
+        if self.rollups is not None:
+            self.rollups.add(timestamp, value)
+        if self.window is not None:
+            self.window.add(timestamp, value)
+
+    def _observe_many(self, flat):
+        """Update rollups and the window with a flat sequence of new samples"""
+        if self.rollups is not None:
+            self.rollups.add_many(flat)
+        if self.window is not None:
+            self.window.add_many(flat[-self.window.capacity * 2:])
+
+    def _check_flush(self):
+        """Flush if the buffer has reached the flush policy limits"""
+        if self._buffered_count >= self.flush_samples or \
+                (self.flush_interval and time() - self._last_flush_time >= self.flush_interval):
+            self.flush()
+
+    def read_chunk(self, start_offset=None, max_samples=None):
+        """Read samples that haven't been acknowledged, for syncing.
+
+        Returns a tuple of the offset at the end of the chunk, and a list of samples. The end
+        offset may be passed to `ack` once the server has stored the samples, or as `start_offset`
+        to read the next chunk while previous chunks are still in flight.
+
+        """
+        with self.lock:
+            self.flush()
+            if start_offset is None:
+                start_offset = self._cursor_offset
+            start_offset = max(start_offset, self._cursor_offset)
+            end_offset = self._chunk_end(start_offset, max_samples)
+            data = self._read_packed(start_offset, end_offset)
+        return max(start_offset, end_offset), _decode_samples(self.sample_format, data)
+
+    def ack(self, offset):
+        """Acknowledge that samples up to `offset` have been synced, so they may be discarded"""
+        with self.lock:
+            offset = min(offset, self._end_offset)
+            if offset <= self._cursor_offset:
+                return
+            self._cursor_offset = offset
+            self._update_count()
+            self._compact()
+
+    def _compact(self):
+        """Discard acknowledged samples from the samples file, if it is worthwhile"""
+        # The cursor is written before the samples file is modified, so an interruption
+        # can only cause samples to be synced again, never lost
+        acked_size = self._cursor_offset - self._origin_offset
+        if self._cursor_offset == self._end_offset:
+            # Everything is acknowledged, so we can simply truncate
+            self._origin_offset = self._cursor_offset
+            self._write_cursor()
+            self._close_file()
+            with open(self.samples_path, 'wb') as f:
+                f.write(self.header)
+            self.index.clear()
+            self.index.save()
+            self._index_block = None
+        elif acked_size * 2 >= self.max_samples * self.sample_size:
+            # Copy the remaining samples when at least half the maximum file size is acknowledged.
+            # Whole blocks are kept, so the index remains valid.
+            origin_offset = self.index.floor(self._cursor_offset)
+            if origin_offset is None:
+                origin_offset = self._index_block[0] if self._index_block else self._cursor_offset
+            data = self._read_offsets(origin_offset, self._end_offset)
+            self._origin_offset = origin_offset
+            self._write_cursor()
+            self._close_file()
+            with atomicwrite.open(self.samples_path, 'wb') as f:
+                f.write(self.header)
+                f.write(data)
+            self.index.prune(origin_offset)
+            self.index.save()
+        else:
+            self._write_cursor()
+
+    def _snapshot_range(self, max_samples=None):
+        """Get the offsets at the start and end of the unacknowledged samples, up to an optional maximum"""
+        with self.lock:
+            self.flush()
+            start_offset = self._cursor_offset
+            return start_offset, max(start_offset, self._chunk_end(start_offset, max_samples))
+
+    def _iter_range(self, start_offset, end_offset, chunk_samples=1024):
+        """Iterate over the samples between two offsets, reading `chunk_samples` at a time"""
+        chunk_offset = start_offset
+        while chunk_offset < end_offset:
             with self.lock:
-                self.check_create()
-                if not exists(self.samples_snapshot_path):
-                    os.rename(self.samples_path, self.samples_snapshot_path)
-                self.check_create()
-        return self.read_samples(self.samples_snapshot_path)
+                # Skip anything acknowledged since we started iterating
+                chunk_offset = max(chunk_offset, self._cursor_offset)
+                chunk_end = min(end_offset, self._chunk_end(chunk_offset, chunk_samples))
+                data = self._read_packed(chunk_offset, chunk_end)
+            if chunk_end <= chunk_offset:
+                break
+            for sample in _decode_samples(self.sample_format, data):
+                yield sample
+            chunk_offset = chunk_end
+
+    def snapshot_samples(self, max_samples=None, lazy=False):
+        """Get samples for syncing, so that sampling may continue uninterrupted.
+
+        The snapshot contains the samples that haven't been acknowledged, up to an optional
+        maximum. Call `remove_snapshot` once they have been synced.
+
+        If `max_samples` is 0 only rollups are synced, so the snapshot is empty, and
+        `remove_snapshot` discards the raw samples so the sampler can't fill up.
+
+        If `lazy` is True, an iterator that reads the samples as it is consumed is returned
+        (or an empty list if there are no samples), so a large snapshot isn't held in memory.
+
+        """
+        if max_samples == 0:
+            self._snapshot_offset = self._get_end_offset()
+            return []
+        if not lazy:
+            self._snapshot_offset, samples = self.read_chunk(max_samples=max_samples)
+            return samples
+        start_offset, self._snapshot_offset = self._snapshot_range(max_samples)
+        if self._snapshot_offset <= start_offset:
+            return []
+        return self._iter_range(start_offset, self._snapshot_offset)
+
+    def _get_end_offset(self):
+        """Get the offset after the last sample"""
+        with self.lock:
+            self.flush()
+            return self._end_offset
 
     def remove_snapshot(self):
-        """Remove any samples snapshot"""
+        """Acknowledge the samples in the last snapshot"""
+        with self.lock:
+            if self._snapshot_offset is not None:
+                self.ack(self._snapshot_offset)
+                self._snapshot_offset = None
+
+
+class RingSampler(Sampler):
+    """A sampler stored in a fixed size, pre-allocated, memory mapped circular file.
+
+    When the ring is full, new samples overwrite the oldest samples rather than being discarded.
+
+    The file consists of the text header, followed by two unsigned 64 bit sequence numbers (the
+    sequence of the oldest sample, and the sequence of the next sample to be written), followed by
+    space for `max_samples` samples. A sample with sequence number n is stored in slot n % max_samples.
+
+    """
+
+    version = "sampler ring"
+    seq_struct = struct.Struct(b'<QQ')
+
+    def __init__(self, path, name, **kwargs):
+        self._map = None
+        super(RingSampler, self).__init__(path, name, **kwargs)
+
+    @property
+    def data_offset(self):
+        return len(self.header) + self.seq_struct.size
+
+    @property
+    def ring_file_size(self):
+        return self.data_offset + self.sample_size * self.max_samples
+
+    @property
+    def full(self):
+        first_seq, next_seq = self._get_seqs()
+        return next_seq - first_seq >= self.max_samples
+
+    @property
+    def pending(self):
+        first_seq, next_seq = self._get_seqs()
+        return next_seq - first_seq
+
+    def check_create(self):
+        """Create and map the ring file if it isn't mapped already"""
+        with self.lock:
+            if self._map is not None:
+                return
+            legacy_samples = self._read_legacy_samples()
+            if not self._check_ring_file():
+                legacy_samples = self._read_ring_file() + legacy_samples
+                self._create_ring_file()
+            self._file = open(self.samples_ring_path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), self.ring_file_size)
+            # Legacy samples were already counted in the rollups, and the window is filled after
+            if legacy_samples:
+                self._write_samples(_interleave(legacy_samples))
+            for legacy_path in (self.samples_path,
+                                self.samples_snapshot_path,
+                                self.samples_cursor_path,
+                                self.index.path):
+                if exists(legacy_path):
+                    os.remove(legacy_path)
+
+    def _check_ring_file(self):
+        """Check the ring file exists and matches the current format and size"""
+        if not exists(self.samples_ring_path):
+            return False
+        if getsize(self.samples_ring_path) != self.ring_file_size:
+            return False
+        with open(self.samples_ring_path, 'rb') as f:
+            header = f.read(len(self.header))
+        return header == self.header
+
+    def _read_legacy_samples(self):
+        """Read samples written by a file sampler, if this sampler was previously stored as a file"""
+        samples = []
+        if exists(self.samples_snapshot_path):
+            samples.extend(Sampler.read_samples(self, self.samples_snapshot_path))
+        if exists(self.samples_path):
+            samples.extend(_decode_samples(*self._read_unacked_file(self.samples_path)))
+        return samples
+
+    def _create_ring_file(self):
+        """Write a new, empty, pre-allocated ring file"""
+        with open(self.samples_ring_path, 'wb') as f:
+            f.write(self.header)
+            f.write(self.seq_struct.pack(0, 0))
+            # Write zeros rather than truncate, so the storage is allocated up front
+            remaining = self.sample_size * self.max_samples
+            zeros = b'\0' * min(remaining, 64 * 1024)
+            while remaining > 0:
+                f.write(zeros[:remaining])
+                remaining -= len(zeros)
+
+    def _get_seqs(self):
+        return self.seq_struct.unpack_from(self._map, len(self.header))
+
+    def _set_seqs(self, first_seq, next_seq):
+        self.seq_struct.pack_into(self._map, len(self.header), first_seq, next_seq)
+
+    def _read_seqs_data(self, first_seq, next_seq):
+        """Get the packed samples between two sequence numbers, in order"""
+        if next_seq <= first_seq:
+            return b''
+        data_offset = self.data_offset
+        sample_size = self.sample_size
+        first_slot = first_seq % self.max_samples
+        end_slot = first_slot + (next_seq - first_seq)
+        start = data_offset + first_slot * sample_size
+        if end_slot <= self.max_samples:
+            return self._map[start:data_offset + end_slot * sample_size]
+        # The samples wrap around the end of the ring
+        wrapped_size = (end_slot - self.max_samples) * sample_size
+        return self._map[start:self.ring_file_size] + self._map[data_offset:data_offset + wrapped_size]
+
+    def _read_seqs(self, first_seq, next_seq):
+        """Read samples between two sequence numbers"""
+        return _decode_samples(self.sample_format, self._read_seqs_data(first_seq, next_seq))
+
+    def _read_data(self, samples_path=None):
+        if samples_path is not None:
+            return super(RingSampler, self)._read_data(samples_path)
+        with self.lock:
+            return self.sample_format, self._read_seqs_data(*self._get_seqs())
+
+    def iter_samples(self, samples_path=None, chunk_samples=1024):
+        """Lazily iterate over (timestamp, value) tuples, oldest first"""
+        if samples_path is not None:
+            for sample in super(RingSampler, self).iter_samples(samples_path, chunk_samples=chunk_samples):
+                yield sample
+            return
+        first_seq, next_seq = self._snapshot_range()
+        for sample in self._iter_range(first_seq, next_seq, chunk_samples):
+            yield sample
+
+    def _snapshot_range(self, max_samples=None):
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+        if max_samples is not None:
+            next_seq = min(next_seq, first_seq + max_samples)
+        return first_seq, next_seq
+
+    def _iter_range(self, first_seq, next_seq, chunk_samples=1024):
+        for chunk_seq in xrange(first_seq, next_seq, chunk_samples):
+            with self.lock:
+                # Skip anything overwritten since we started iterating
+                chunk_seq = max(chunk_seq, self._get_seqs()[0])
+                data = self._read_seqs_data(chunk_seq, min(chunk_seq + chunk_samples, next_seq))
+            for sample in _decode_samples(self.sample_format, data):
+                yield sample
+
+    def reset(self):
+        """Reset samples"""
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+            self._set_seqs(next_seq, next_seq)
+            self._snapshot_offset = None
+
+    def add_sample(self, timestamp, value):
+        """Add a sample, overwriting the oldest sample if the ring is full. Always returns True."""
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+            offset = self.data_offset + (next_seq % self.max_samples) * self.sample_size
+            self.sample_struct.pack_into(self._map, offset, timestamp, value)
+            next_seq += 1
+            self._set_seqs(max(first_seq, next_seq - self.max_samples), next_seq)
+            self._observe(timestamp, value)
+        return True
+
+    def add_samples(self, samples, values=None):
+        """Add many samples, overwriting the oldest samples if the ring fills up.
+
+        Returns the number of samples supplied, since a ring never rejects samples.
+
+        """
+        flat = _interleave(samples, values)
+        count = len(flat) // 2
+        if not count:
+            return 0
+        with self.lock:
+            self._write_samples(flat)
+            self._observe_many(flat)
+        return count
+
+    def _write_samples(self, flat):
+        """Write a flat list of timestamps and values in to the ring"""
+        count = len(flat) // 2
+        # Only the newest samples will survive if there are more than fit in the ring
+        stored_count = min(count, self.max_samples)
+        pack_format = b'<' + (self.time_format + self.value_format) * stored_count
+        data = struct.pack(pack_format, *flat[(count - stored_count) * 2:])
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+            start_seq = next_seq + count - stored_count
+            slot = start_seq % self.max_samples
+            # Write in up to two runs, in case the samples wrap around the end of the ring
+            run_size = min(stored_count, self.max_samples - slot) * self.sample_size
+            data_offset = self.data_offset
+            start = data_offset + slot * self.sample_size
+            self._map[start:start + run_size] = data[:run_size]
+            if run_size < len(data):
+                self._map[data_offset:data_offset + len(data) - run_size] = data[run_size:]
+            next_seq += count
+            self._set_seqs(max(first_seq, next_seq - self.max_samples), next_seq)
+
+    def read_range(self, start_time, end_time):
+        """Read samples with timestamps between `start_time` and `end_time` (inclusive)"""
+        return [sample for sample in self.read_samples()
+                if start_time <= sample[0] <= end_time]
+
+    def read_last(self, count):
+        """Read the last `count` samples"""
+        if count <= 0:
+            return []
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+            return self._read_seqs(max(first_seq, next_seq - count), next_seq)
+
+    def read_chunk(self, start_offset=None, max_samples=None):
+        """Read samples for syncing. For a ring sampler, offsets are sequence numbers."""
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+            if start_offset is not None:
+                first_seq = max(first_seq, start_offset)
+            if max_samples is not None:
+                next_seq = min(next_seq, first_seq + max_samples)
+            return max(first_seq, next_seq), self._read_seqs(first_seq, next_seq)
+
+    def _get_end_offset(self):
+        with self.lock:
+            return self._get_seqs()[1]
+
+    def ack(self, offset):
+        """Discard samples up to sequence number `offset`"""
+        with self.lock:
+            first_seq, next_seq = self._get_seqs()
+            self._set_seqs(max(first_seq, min(offset, next_seq)), next_seq)
+
+    def flush(self):
+        """Write changes to the ring to disk"""
+        with self.lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        """Unmap and close the ring file"""
+        with self.lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._map = None
+            self._close_file()
+            if self.rollups is not None:
+                self.rollups.close()
+
+
+class CompressedSampler(Sampler):
+    """A file sampler that stores samples in compressed blocks (the "sampler v2" format).
+
+    Timestamps are delta-of-delta encoded (to the nearest microsecond), and values are XOR
+    encoded against the previous value (see `dataplicity.client.gorilla`). Each flush writes one
+    or more blocks, so compression is most effective when `flush_samples` is large. It defaults to
+    `min_block_samples`, since small blocks can be larger than uncompressed samples.
+
+    Offsets and the sampler's cursor always fall on block boundaries.
+
+    """
+
+    version = "sampler v2"
+    min_block_samples = 256
+    max_block_samples = 4096
+
+    def __init__(self, path, name, **kwargs):
+        if (kwargs.get('time_format', 'd'), kwargs.get('value_format', 'd')) != ('d', 'd'):
+            raise SamplerError("compressed samplers require 'd' time and value formats")
+        kwargs.setdefault('flush_samples', self.min_block_samples)
+        # A list of (start offset, end offset, sample count) for blocks in the samples file
+        self._blocks = []
+        super(CompressedSampler, self).__init__(path, name, **kwargs)
+
+    def _measure_body(self):
+        """Read the block headers, and get the size of the complete blocks"""
+        _, _, data = self._read_file(self.samples_path)
+        origin_offset = self._origin_offset
+        self._blocks = [(origin_offset + offset, origin_offset + offset + size, count)
+                        for offset, size, count, _payload in gorilla.iter_blocks(data)]
+        return self._blocks[-1][1] - origin_offset if self._blocks else 0
+
+    def _update_count(self):
+        cursor_offset = self._cursor_offset
+        unacked_count = sum(count for start, _end, count in self._blocks if start >= cursor_offset)
+        self._sample_count = unacked_count + self._buffered_count
+
+    def _encode_blocks(self, data):
+        """Encode packed samples in to blocks, returns a list of (block, flat samples in block)"""
+        flat = _decode_flat(self.sample_format, data)
+        block_size = self.max_block_samples * 2
+        return [(gorilla.encode_block(flat[start:start + block_size]), flat[start:start + block_size])
+                for start in xrange(0, len(flat), block_size)]
+
+    def _encode(self, data):
+        return b''.join(block for block, _flat in self._encode_blocks(data))
+
+    def _unpack_raw(self, data):
+        flat = gorilla.decode_blocks(data)
+        return struct.pack(b'<' + b'dd' * (len(flat) // 2), *flat)
+
+    def _index_data(self, start_offset, data, flat=None):
+        """Get index entries for the blocks in `data`; every block is indexed."""
+        entries = []
+        for offset, size, count, payload in gorilla.iter_blocks(data):
+            timestamps = gorilla.decode_payload(payload, count)[0::2]
+            entries.append(self._make_entry(start_offset + offset, data[offset:offset + size], timestamps))
+        return entries
+
+    def _make_entry(self, start_offset, block, timestamps):
+        return (start_offset,
+                start_offset + len(block),
+                len(timestamps),
+                min(timestamps),
+                max(timestamps),
+                zlib.crc32(block) & 0xffffffff)
+
+    def flush(self):
+        """Encode buffered samples in to blocks, and write them to disk"""
+        with self.lock:
+            if self._buffer:
+                f = self._open()
+                entries = []
+                for block, block_flat in self._encode_blocks(b''.join(self._buffer)):
+                    f.write(block)
+                    count = len(block_flat) // 2
+                    self._blocks.append((self._end_offset, self._end_offset + len(block), count))
+                    entries.append(self._make_entry(self._end_offset, block, block_flat[0::2]))
+                    self._end_offset += len(block)
+                f.flush()
+                self.index.append(entries)
+                del self._buffer[:]
+                self._buffered_count = 0
+            self._last_flush_time = time()
+
+    def _chunk_end(self, start_offset, max_samples=None):
+        if max_samples is None:
+            return self._end_offset
+        end_offset = start_offset
+        count = 0
+        for block_start, block_end, block_count in self._blocks:
+            if block_start < start_offset:
+                continue
+            # Always include at least one block, so oversized blocks can't stall syncing
+            if count + block_count > max_samples and (count or not max_samples):
+                break
+            count += block_count
+            end_offset = block_end
+        return end_offset
+
+    def ack(self, offset):
+        with self.lock:
+            super(CompressedSampler, self).ack(offset)
+            cursor_offset = self._cursor_offset
+            self._blocks = [block for block in self._blocks if block[0] >= cursor_offset]
+
+    def reset(self):
+        with self.lock:
+            super(CompressedSampler, self).reset()
+            del self._blocks[:]
+
+
+class SegmentStore(object):
+    """An append-only store shared by many samplers.
+
+    Rather than a directory and samples file per sampler, samples from every series are appended
+    to the same segment file as fixed size records tagged with a compact series id. Series names
+    are mapped on to ids in a small text file.
+
+    Syncing rotates the active segment once, and each series streams its records from the closed
+    segments that contain it, so the samples are never all decoded at once. Each series
+    acknowledges its own position (segment number and number of samples in that segment), and a
+    closed segment is deleted once every series in it has been acknowledged.
+
+    """
+
+    segment_header = "sampler segment v1\n"
+    record_struct = struct.Struct(b'<Hdd')
+    max_series = 0xffff
+    # Number of records read from a segment file at a time
+    read_records = 4096
+
+    def __init__(self, path, flush_samples=1, flush_interval=0.0):
+        self.path = abspath(path)
+        self.flush_samples = max(1, flush_samples)
+        self.flush_interval = flush_interval
+        self.series_path = join(self.path, 'series.map')
+        self.cursors_path = join(self.path, 'series.cursor')
+        self.lock = RLock()
+
+        self._series = {}
+        # Series registered by a sampler since startup
+        self._open_series = set()
+        # Maps series id on to the acknowledged position (segment number, sample count)
+        self._cursors = {}
+        self._cursors_dirty = False
+        # Maps segment number on to a dict of series id and sample count
+        self._segment_counts = {}
+        # Maps series id on to the number of unacknowledged samples
+        self._pending = {}
+        # Closed segments that may be read for the current sync, or None before the first read
+        self._snapshot = None
+        self._snapshot_series = set()
+
+        self._file = None
+        self._buffer = []
+        self._buffered_count = 0
+        self._last_flush_time = time()
+
         try:
-            os.remove(self.samples_snapshot_path)
+            os.makedirs(self.path)
         except OSError:
             pass
+        self._read_series()
+        self._read_cursors()
+        self._scan()
+
+    def _segment_path(self, segment):
+        return join(self.path, "{:08d}.seg".format(segment))
+
+    @property
+    def active_segment(self):
+        return max(self._segment_counts)
+
+    def _read_series(self):
+        try:
+            with open(self.series_path, 'rb') as f:
+                for line in f:
+                    series_id, _, name = line.rstrip('\n').partition(' ')
+                    self._series[name] = int(series_id)
+        except IOError:
+            pass
+
+    def _write_series(self):
+        with atomicwrite.open(self.series_path, 'wb') as f:
+            for name, series_id in sorted(self._series.items(), key=lambda item: item[1]):
+                f.write("{} {}\n".format(series_id, name))
+
+    def _read_cursors(self):
+        try:
+            with open(self.cursors_path, 'rb') as f:
+                for line in f:
+                    series_id, segment, count = [int(value) for value in line.split()]
+                    self._cursors[series_id] = (segment, count)
+        except (IOError, ValueError):
+            # Worst case, samples are synced again
+            self._cursors.clear()
+
+    def _write_cursors(self):
+        with atomicwrite.open(self.cursors_path, 'wb') as f:
+            for series_id, (segment, count) in sorted(self._cursors.items()):
+                f.write("{} {} {}\n".format(series_id, segment, count))
+        self._cursors_dirty = False
+
+    def _read_segment(self, segment):
+        """Read the records in a segment, ignoring a partially written record at the end"""
+        with open(self._segment_path(segment), 'rb') as f:
+            f.readline()
+            data = f.read()
+        return data[:len(data) - len(data) % self.record_struct.size]
+
+    def _iter_records(self, data):
+        unpack_from = self.record_struct.unpack_from
+        for offset in xrange(0, len(data), self.record_struct.size):
+            yield unpack_from(data, offset)
+
+    def _scan(self):
+        """Count the samples in each segment, and start a new active segment"""
+        segments = sorted(int(filename[:-4]) for filename in os.listdir(self.path)
+                          if filename.endswith('.seg') and filename[:-4].isdigit())
+        for segment in segments:
+            counts = self._segment_counts[segment] = {}
+            for series_id, _timestamp, _value in self._iter_records(self._read_segment(segment)):
+                counts[series_id] = counts.get(series_id, 0) + 1
+        # Never append to a segment from a previous run, which may end with a partial record
+        self._start_segment((segments[-1] + 1) if segments else 0)
+        for series_id in self._series.itervalues():
+            self._update_pending(series_id)
+
+    def _start_segment(self, segment):
+        self._close_file()
+        with open(self._segment_path(segment), 'wb') as f:
+            f.write(self.segment_header)
+        self._segment_counts[segment] = {}
+
+    def _update_pending(self, series_id):
+        acked_segment, acked_count = self._cursors.get(series_id, (-1, 0))
+        pending = 0
+        for segment, counts in self._segment_counts.iteritems():
+            if segment >= acked_segment:
+                pending += counts.get(series_id, 0)
+                if segment == acked_segment:
+                    pending -= acked_count
+        self._pending[series_id] = max(0, pending)
+
+    def get_series_id(self, name):
+        """Get the id of a named series, allocating a new id if required"""
+        with self.lock:
+            series_id = self._series.get(name)
+            if series_id is None:
+                series_id = max(self._series.itervalues()) + 1 if self._series else 0
+                if series_id > self.max_series:
+                    raise SamplerError("too many series in segment store")
+                self._series[name] = series_id
+                self._write_series()
+                self._pending[series_id] = 0
+            self._open_series.add(series_id)
+            return series_id
+
+    def pending(self, series_id):
+        """Get the number of unacknowledged samples in a series"""
+        return self._pending.get(series_id, 0)
+
+    def add(self, series_id, flat):
+        """Append samples from a flat sequence of alternating timestamps and values"""
+        count = len(flat) // 2
+        if not count:
+            return
+        records = [None] * (count * 3)
+        records[0::3] = [series_id] * count
+        records[1::3] = flat[0::2]
+        records[2::3] = flat[1::2]
+        data = struct.pack(b'<' + b'Hdd' * count, *records)
+        with self.lock:
+            self._buffer.append(data)
+            self._buffered_count += count
+            counts = self._segment_counts[self.active_segment]
+            counts[series_id] = counts.get(series_id, 0) + count
+            self._pending[series_id] = self._pending.get(series_id, 0) + count
+            if self._buffered_count >= self.flush_samples or \
+                    (self.flush_interval and time() - self._last_flush_time >= self.flush_interval):
+                self.flush()
+
+    def flush(self):
+        """Write buffered samples to the active segment"""
+        with self.lock:
+            if self._buffer:
+                if self._file is None:
+                    self._file = open(self._segment_path(self.active_segment), 'ab')
+                self._file.write(b''.join(self._buffer))
+                self._file.flush()
+                del self._buffer[:]
+                self._buffered_count = 0
+            self._last_flush_time = time()
+
+    def flush_if_due(self):
+        """Flush if samples are buffered and `flush_interval` seconds have elapsed since the last write"""
+        with self.lock:
+            if self._buffered_count and self.flush_interval and \
+                    time() - self._last_flush_time >= self.flush_interval:
+                self.flush()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """Flush buffered samples and persist acknowledgements"""
+        with self.lock:
+            self.flush()
+            self._close_file()
+            if self._cursors_dirty:
+                self._write_cursors()
+
+    def _take_snapshot(self):
+        """Rotate the active segment, so the closed segments may be synced"""
+        self.flush()
+        if self._segment_counts[self.active_segment]:
+            self._start_segment(self.active_segment + 1)
+        self._snapshot = sorted(self._segment_counts)[:-1]
+        self._snapshot_series.clear()
+
+    def chunk_runs(self, series_id, start=None, max_samples=None):
+        """Find unacknowledged samples in closed segments, without reading them.
+
+        Returns a tuple of the position at the end of the chunk, and a list of runs of
+        (segment, first sample, end sample) which may be read with `iter_runs`. The first chunk
+        found for a series since the last `commit` rotates the active segment if required.
+
+        """
+        with self.lock:
+            if self._snapshot is None or (start is None and series_id in self._snapshot_series):
+                self._take_snapshot()
+            self._snapshot_series.add(series_id)
+            position = self._cursors.get(series_id, (-1, 0))
+            if start is not None:
+                position = max(position, start)
+            runs = []
+            remaining = max_samples
+            for segment in self._snapshot:
+                if remaining is not None and remaining <= 0:
+                    break
+                if segment < position[0]:
+                    continue
+                first = position[1] if segment == position[0] else 0
+                last = self._segment_counts.get(segment, {}).get(series_id, 0)
+                if remaining is not None:
+                    last = min(last, first + remaining)
+                    remaining -= max(0, last - first)
+                if last <= first:
+                    continue
+                runs.append((segment, first, last))
+                position = (segment, last)
+        return position, runs
+
+    def iter_runs(self, series_id, runs):
+        """Iterate over the (timestamp, value) tuples of a series in runs returned by `chunk_runs`"""
+        read_size = self.record_struct.size * self.read_records
+        for segment, first, last in runs:
+            ordinal = 0
+            with open(self._segment_path(segment), 'rb') as f:
+                f.readline()
+                while ordinal < last:
+                    data = f.read(read_size)
+                    data = data[:len(data) - len(data) % self.record_struct.size]
+                    if not data:
+                        break
+                    for record_series_id, timestamp, value in self._iter_records(data):
+                        if record_series_id != series_id:
+                            continue
+                        if first <= ordinal < last:
+                            yield timestamp, value
+                        ordinal += 1
+
+    def read_chunk(self, series_id, start=None, max_samples=None):
+        """Read unacknowledged samples from closed segments.
+
+        Returns a tuple of the position at the end of the chunk, and a list of samples. The first
+        chunk read by a series since the last `commit` rotates the active segment if required.
+
+        """
+        position, runs = self.chunk_runs(series_id, start=start, max_samples=max_samples)
+        return position, list(self.iter_runs(series_id, runs))
+
+    def ack(self, series_id, position):
+        """Acknowledge samples in a series up to `position`. Call `commit` to persist."""
+        with self.lock:
+            if position <= self._cursors.get(series_id, (-1, 0)):
+                return
+            self._cursors[series_id] = position
+            self._cursors_dirty = True
+            self._update_pending(series_id)
+
+    def end_position(self, series_id):
+        """Get the position after the last sample in a series"""
+        with self.lock:
+            self.flush()
+            active_segment = self.active_segment
+            return active_segment, self._segment_counts[active_segment].get(series_id, 0)
+
+    def reset(self, series_id):
+        """Acknowledge every sample in a series"""
+        with self.lock:
+            self.ack(series_id, self.end_position(series_id))
+
+    def commit(self):
+        """Persist acknowledgements, and delete closed segments that are fully acknowledged.
+
+        Series that haven't been registered since startup (i.e. samplers no longer in the conf)
+        don't prevent a segment from being deleted.
+
+        """
+        with self.lock:
+            self._snapshot = None
+            self._snapshot_series.clear()
+            if not self._cursors_dirty:
+                return
+            # Cursors must be on disk before segments are deleted
+            self._write_cursors()
+            active_segment = self.active_segment
+            for segment, counts in sorted(self._segment_counts.items()):
+                if segment == active_segment:
+                    continue
+                if all(self._cursors.get(series_id, (-1, 0)) >= (segment, count)
+                       for series_id, count in counts.iteritems()
+                       if series_id in self._open_series):
+                    try:
+                        os.remove(self._segment_path(segment))
+                    except OSError:
+                        log.exception("unable to remove segment {}".format(segment))
+                        continue
+                    del self._segment_counts[segment]
+
+    def read_series(self, series_ids):
+        """Read all the unacknowledged samples for the given series ids.
+
+        Returns a dict that maps each series id on to a flat list of timestamps and values.
+
+        """
+        with self.lock:
+            self.flush()
+            series = dict((series_id, []) for series_id in series_ids)
+            for segment in sorted(self._segment_counts):
+                segment_offsets = {}
+                for series_id, timestamp, value in self._iter_records(self._read_segment(segment)):
+                    flat = series.get(series_id)
+                    if flat is None:
+                        continue
+                    index = segment_offsets[series_id] = segment_offsets.get(series_id, 0) + 1
+                    acked_segment, acked_count = self._cursors.get(series_id, (-1, 0))
+                    if segment < acked_segment or (segment == acked_segment and index <= acked_count):
+                        continue
+                    flat.append(timestamp)
+                    flat.append(value)
+        return series
+
+
+class SegmentSampler(object):
+    """A sampler that stores samples in a shared `SegmentStore`.
+
+    Provides the same interface as `Sampler`, but offsets passed to `read_chunk` and `ack` are
+    positions in the store.
+
+    """
+
+    def __init__(self,
+                 store,
+                 name,
+                 max_samples=1000,
+                 rollup_periods=None,
+                 window_samples=0):
+        self.store = store
+        self.name = name
+        self.max_samples = max_samples
+        self.sync_max_samples = None
+        self.lock = store.lock
+        self.series_id = store.get_series_id(name)
+        self._snapshot_position = None
+        if rollup_periods:
+            self.rollups = Rollups(join(store.path, name + '.smr'), rollup_periods)
+        else:
+            self.rollups = None
+        if window_samples:
+            self.window = SampleWindow(window_samples, lock=self.lock)
+        else:
+            self.window = None
+
+    @property
+    def full(self):
+        """Check if the sampler has more than the maximum number of samples"""
+        return self.store.pending(self.series_id) >= self.max_samples
+
+    @property
+    def pending(self):
+        """The number of samples waiting to be synced"""
+        return self.store.pending(self.series_id)
+
+    def add_sample(self, timestamp, value):
+        """Add a sample, return True if the sample was added"""
+        with self.lock:
+            self._observe(timestamp, value)
+            if self.full:
+                return False
+            self.store.add(self.series_id, [timestamp, value])
+        return True
+
+    def add_samples(self, samples, values=None):
+        """Add many samples at once, return the number of samples added"""
+        flat = _interleave(samples, values)
+        with self.lock:
+            self._observe_many(flat)
+            count = min(len(flat) // 2, max(0, self.max_samples - self.store.pending(self.series_id)))
+            if not count:
+                return 0
+            self.store.add(self.series_id, flat[:count * 2])
+        return count
+
+    def _observe(self, timestamp, value):
+        if self.rollups is not None:
+            self.rollups.add(timestamp, value)
+        if self.window is not None:
+            self.window.add(timestamp, value)
+
+    def _observe_many(self, flat):
+        if self.rollups is not None:
+            self.rollups.add_many(flat)
+        if self.window is not None:
+            self.window.add_many(flat[-self.window.capacity * 2:])
+
+    def read_samples(self):
+        """Read all the unacknowledged samples in to a list of tuples (timestamp, value)"""
+        flat = self.store.read_series([self.series_id])[self.series_id]
+        return zip(flat[0::2], flat[1::2])
+
+    def read_range(self, start_time, end_time):
+        """Read samples with timestamps between `start_time` and `end_time` (inclusive)"""
+        return [sample for sample in self.read_samples()
+                if start_time <= sample[0] <= end_time]
+
+    def read_last(self, count):
+        """Read the last `count` samples"""
+        if count <= 0:
+            return []
+        return self.read_samples()[-count:]
+
+    def iter_samples(self, chunk_samples=1024):
+        """Iterate over (timestamp, value) tuples"""
+        return iter(self.read_samples())
+
+    def read_chunk(self, start_offset=None, max_samples=None):
+        """Read samples that haven't been acknowledged, for syncing"""
+        return self.store.read_chunk(self.series_id, start=start_offset, max_samples=max_samples)
+
+    def ack(self, offset):
+        """Acknowledge samples up to a position returned by `read_chunk`"""
+        self.store.ack(self.series_id, offset)
+
+    def snapshot_samples(self, max_samples=None, lazy=False):
+        """Get samples for syncing. Call `remove_snapshot` once they have been synced.
+
+        If `max_samples` is 0, the snapshot is empty and `remove_snapshot` discards raw samples.
+        If `lazy` is True, an iterator that reads the samples from the segments as it is consumed
+        is returned (or an empty list if there are no samples).
+
+        """
+        if max_samples == 0:
+            self._snapshot_position = self.store.end_position(self.series_id)
+            return []
+        self._snapshot_position, runs = self.store.chunk_runs(self.series_id, max_samples=max_samples)
+        if not runs:
+            return []
+        samples = self.store.iter_runs(self.series_id, runs)
+        return samples if lazy else list(samples)
+
+    def remove_snapshot(self):
+        """Acknowledge the samples in the last snapshot"""
+        with self.lock:
+            if self._snapshot_position is not None:
+                self.ack(self._snapshot_position)
+                self._snapshot_position = None
+
+    def reset(self):
+        """Reset samples"""
+        with self.lock:
+            self.store.reset(self.series_id)
+            self._snapshot_position = None
+
+    def flush(self):
+        """Write buffered samples to disk"""
+        self.store.flush()
+
+    def flush_if_due(self):
+        """Write buffered samples if the store's flush interval has elapsed"""
+        self.store.flush_if_due()
+
+    def close(self):
+        """Close rollups. The store is closed by the sampler manager."""
+        with self.lock:
+            if self.rollups is not None:
+                self.rollups.close()
+
+
+# maps the [sampler:*]/storage conf value on to a sampler class
+_storage_registry = {
+    "file": Sampler,
+    "ring": RingSampler
+}
 
 
 if __name__ == "__main__":
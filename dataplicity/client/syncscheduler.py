@@ -0,0 +1,173 @@
+"""
+Decides when the daemon should sync.
+
+The daemon syncs every `poll` seconds, but the interval adapts to the device's backlog and to
+recent syncs:
+
+ * When any sampler or timeline fills past `sync_threshold` of its capacity, a sync is started
+   early (no sooner than `min_poll` seconds after the last one). If an early sync doesn't
+   reduce the backlog, e.g. because the server is holding back samples, the next sync waits for
+   the interval.
+ * When a sync had nothing to send, the interval is stretched by `backoff`, up to `max_poll`.
+   Once there is something to send again, the next sync waits no longer than the interval.
+ * When syncs fail, the interval is stretched by `backoff` for each consecutive failure, and
+   slow syncs stretch the interval to `slow_factor` times the time the last sync took.
+
+Sync requests (from the push server or the command pipe) are coalesced, so any number of
+requests made before a sync starts result in a single sync.
+
+"""
+
+from dataplicity import errors
+
+from threading import Lock
+from time import time
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+class SyncScheduler(object):
+    """Schedules syncs for a client"""
+
+    def __init__(self,
+                 client,
+                 interval=60.0,
+                 min_interval=5.0,
+                 max_interval=600.0,
+                 threshold=0.5,
+                 backoff=2.0,
+                 slow_factor=4.0):
+        self.client = client
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.threshold = threshold
+        self.backoff = backoff
+        self.slow_factor = slow_factor
+        # Backlog is checked at most once every this many seconds
+        self.check_interval = 1.0
+        # Limit on the number of times the interval is stretched by backoff
+        self.max_backoffs = 16
+
+        self._lock = Lock()
+        self._requests = []
+        self._last_sync = None
+        self._last_duration = 0.0
+        self._last_check = 0.0
+        self._sync_start = None
+        self._sync_backlog = 0
+        self._failures = 0
+        self._idle_syncs = 0
+        # True if the sync is early, because of the backlog
+        self._early = False
+        # True if an early sync didn't reduce the backlog
+        self._stalled = False
+
+    @classmethod
+    def init_from_conf(cls, client, conf):
+        interval = conf.get_float('daemon', 'poll', 60.0)
+        min_interval = conf.get_float('daemon', 'min_poll', min(5.0, interval))
+        max_interval = conf.get_float('daemon', 'max_poll', interval * 10)
+        threshold = conf.get_float('daemon', 'sync_threshold', 0.5)
+        backoff = conf.get_float('daemon', 'backoff', 2.0)
+        if not min_interval <= interval <= max_interval:
+            raise errors.ConfigError("[daemon] values should be min_poll <= poll <= max_poll")
+        if backoff < 1.0:
+            raise errors.ConfigError("[daemon]/backoff should be 1 or more")
+        return cls(client,
+                   interval=interval,
+                   min_interval=min_interval,
+                   max_interval=max_interval,
+                   threshold=threshold,
+                   backoff=backoff)
+
+    def request(self, reason):
+        """Request a sync as soon as possible"""
+        with self._lock:
+            if reason not in self._requests:
+                self._requests.append(reason)
+
+    def get_backlog(self):
+        """Get the number of samples and events waiting to be synced, and the greatest fraction
+        of any sampler or timeline's capacity that is used"""
+        count = 0
+        fill = 0.0
+        samplers = self.client.samplers
+        for sampler_name in samplers.enumerate_samplers():
+            sampler = samplers.get_sampler(sampler_name)
+            pending = sampler.pending
+            count += pending
+            if sampler.max_samples:
+                fill = max(fill, float(pending) / sampler.max_samples)
+        for timeline in self.client.timelines:
+            stats = timeline.stats()
+            count += stats['count']
+            if timeline.max_events:
+                fill = max(fill, float(stats['count']) / timeline.max_events)
+            if timeline.max_bytes:
+                fill = max(fill, float(stats['bytes']) / timeline.max_bytes)
+            if not (timeline.max_events or timeline.max_bytes) and timeline.sync_max_events:
+                # Unlimited, so measure against what a single sync can send
+                capacity = timeline.sync_max_events * timeline.sync_chunks
+                fill = max(fill, float(stats['count']) / capacity)
+        return count, fill
+
+    def get_interval(self, idle=True):
+        """Get the current interval between syncs. If `idle` is False, the interval isn't
+        stretched for syncs that had nothing to send."""
+        backoffs = self._failures + (self._idle_syncs if idle else 0)
+        interval = self.interval * self.backoff ** backoffs
+        interval = max(interval, self._last_duration * self.slow_factor)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def get_sync_reason(self, t=None):
+        """Get the reason a sync is due, or None if no sync is due"""
+        if t is None:
+            t = time()
+        self._early = False
+        with self._lock:
+            if self._requests:
+                return ", ".join(self._requests)
+        if self._last_sync is None:
+            return "startup"
+        elapsed = t - self._last_sync
+        if elapsed >= self.get_interval():
+            return "poll"
+        if self._failures or self._stalled or t - self._last_check < self.check_interval:
+            return None
+        # Don't sync early more often than min_interval, or spend more than half the time syncing
+        if elapsed >= max(self.min_interval, self._last_duration):
+            self._last_check = t
+            count, fill = self.get_backlog()
+            if fill >= self.threshold:
+                self._early = True
+                return "backlog {:.0%} full".format(fill)
+            if count and self._idle_syncs and elapsed >= self.get_interval(idle=False):
+                # The interval was stretched when there was nothing to send, but now there is
+                return "backlog"
+        return None
+
+    def start_sync(self):
+        """Called when a sync starts, satisfies any pending requests"""
+        with self._lock:
+            del self._requests[:]
+        self._sync_start = time()
+        self._sync_backlog, _fill = self.get_backlog()
+
+    def end_sync(self, success):
+        """Called when a sync completes (or fails)"""
+        now = time()
+        self._last_sync = now
+        self._last_duration = now - self._sync_start
+        backlog, _fill = self.get_backlog()
+        self._stalled = self._early and backlog >= self._sync_backlog
+        if success:
+            self._failures = 0
+            if self._sync_backlog:
+                self._idle_syncs = 0
+            else:
+                self._idle_syncs = min(self.max_backoffs, self._idle_syncs + 1)
+        else:
+            self._failures = min(self.max_backoffs, self._failures + 1)
+        log.debug("next sync in {:0.1f}s".format(self.get_interval()))
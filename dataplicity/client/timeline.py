@@ -4,18 +4,32 @@ Creates a database of timestamped events.
 """
 
 from dataplicity import constants
+from dataplicity import errors
+from dataplicity import atomicwrite
+from dataplicity.client import eventcodecs
+from dataplicity.client.imagepipeline import ImagePipeline, parse_size
+from dataplicity.jsonstream import StreamString
 
+import os
 import os.path
+import errno
 from os.path import splitext
 from time import time
+from threading import RLock, Thread, Event as ThreadEvent
+from heapq import nsmallest
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+import struct
+import zlib
 from random import randint
 from json import dumps, loads
 from operator import itemgetter
 from base64 import b64encode
-from os.path import basename
+from os.path import basename, getmtime
+from hashlib import sha1
 
 from fs.osfs import OSFS
-from fs.errors import FSError
+from fs.errors import FSError, ResourceNotFoundError
 
 import logging
 log = logging.getLogger('dataplicity')
@@ -58,6 +72,8 @@ class Event(object):
         self.timestamp = timestamp
         self.attachments = []
         self.data = {}
+        # Blobs referenced by this event, until it is written
+        self._blob_refs = []
         self.init(*args, **kwargs)
         super(Event, self).__init__()
 
@@ -85,26 +101,38 @@ class Event(object):
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is None:
             self.write()
+        else:
+            self.discard()
 
     def attach_file(self, filename, name=None, ext=None):
         """Attach a file to this event"""
         if name is None:
             name = filename
         with open(filename, 'rb') as f:
-            data_bin = f.read()
-        return self.attach_bytes(data_bin, filename=filename, name=name)
+            return self.attach_stream(f, filename=filename, name=name, ext=ext)
+
+    def attach_stream(self, stream, filename=None, name=None, ext=None):
+        """Attach the contents of a file-like object to this event, which is copied in chunks"""
+        blob, size = self.timeline._write_blob(stream)
+        return self._add_attachment(blob, size, filename=filename, name=name, ext=ext)
 
     def attach_bytes(self, data_bin, filename=None, name=None, ext=None):
         """Attach binary data to this event"""
+        blob, size = self.timeline._write_blob(data_bin)
+        return self._add_attachment(blob, size, filename=filename, name=name, ext=ext)
+
+    def _add_attachment(self, blob, size, filename=None, name=None, ext=None):
+        self._blob_refs.append(blob)
         if ext is None and filename is not None:
             ext = splitext(filename)[-1]
-        data_b64 = b64encode(data_bin)
         if filename is not None:
             filename_base = basename(filename)
         else:
             filename_base = None
+        # The data is stored in a blob file, and is only base64 encoded when syncing
         attachment = {
-            "data": data_b64,
+            "blob": blob,
+            "size": size,
             "encoding": 'base64',
             "name": name or filename_base,
             "filename": filename_base,
@@ -113,9 +141,18 @@ class Event(object):
         self.attachments.append(attachment)
         return self
 
+    def discard(self):
+        """Release the attachments of an event that won't be written"""
+        self.timeline._release_blobs(self._blob_refs)
+        del self._blob_refs[:]
+        del self.attachments[:]
+
     def write(self):
         """Write the event (called automatically)"""
         self.timeline._write_event(self.event_id, self)
+        # The event record now references the blobs
+        self.timeline._release_blobs(self._blob_refs)
+        del self._blob_refs[:]
         return self
 
 
@@ -136,6 +173,31 @@ class ImageEvent(Event):
         self.filename = filename
         self.name = name
         self.ext = ext
+        # Image data waiting for the timeline's image pipeline (data, filename, ext)
+        self._image = None
+
+    def set_image(self, data, filename=None, ext=None):
+        """Set image data to be processed and attached when the event is written"""
+        self._image = (data, filename, ext)
+
+    def pop_image(self):
+        image = self._image
+        self._image = None
+        return image
+
+    def write(self):
+        """Write the event, or queue it to be written once the image has been processed"""
+        if self._image is not None and self.timeline.images is not None:
+            self.timeline.images.submit(self)
+            return self
+        if self._image is not None:
+            data, filename, ext = self.pop_image()
+            self.attach_bytes(data, name='photo', filename=filename, ext=ext)
+        return super(ImageEvent, self).write()
+
+    def discard(self):
+        self._image = None
+        super(ImageEvent, self).discard()
 
     def to_data(self):
         return {"timestamp": self.timestamp,
@@ -150,12 +212,100 @@ class ImageEvent(Event):
                 "attachments": self.attachments}
 
 
+class BlobStore(object):
+    """Stores attachment data in files, outside of the event records.
+
+    Blobs are named by the SHA1 of their contents, so identical attachments are stored once.
+
+    """
+
+    # A multiple of 3, so base64 encoded chunks may be concatenated
+    chunk_size = 48 * 1024
+
+    def __init__(self, path):
+        self.fs = OSFS(path, create=True)
+
+    def _filename(self, blob):
+        return "{}.blob".format(blob)
+
+    def _store(self, tmp_filename, blob):
+        """Move a temporary file in to place, unless the blob already exists"""
+        filename = self._filename(blob)
+        if self.fs.exists(filename):
+            self.fs.remove(tmp_filename)
+        else:
+            self.fs.rename(tmp_filename, filename)
+
+    def write_stream(self, stream):
+        """Copy a file-like object in to a blob, return the blob name and size"""
+        tmp_filename = "{:08x}.tmp".format(randint(0, 0xffffffff))
+        content_hash = sha1()
+        size = 0
+        with self.fs.open(tmp_filename, 'wb') as f:
+            while 1:
+                chunk = stream.read(self.chunk_size)
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        blob = content_hash.hexdigest()
+        self._store(tmp_filename, blob)
+        return blob, size
+
+    def write_bytes(self, data):
+        """Write data to a blob, return the blob name and size"""
+        blob = sha1(data).hexdigest()
+        if not self.fs.exists(self._filename(blob)):
+            tmp_filename = "{:08x}.tmp".format(randint(0, 0xffffffff))
+            with self.fs.open(tmp_filename, 'wb') as f:
+                f.write(data)
+            self._store(tmp_filename, blob)
+        return blob, len(data)
+
+    def list_blobs(self):
+        """Get a list of tuples of (blob or temporary filename, modified time)"""
+        return [(splitext(filename)[0] if filename.endswith('.blob') else filename,
+                 getmtime(self.fs.getsyspath(filename)))
+                for filename in self.fs.listdir(files_only=True)]
+
+    def iter_base64(self, blob, chunk_size=None):
+        """Read a blob and yield base64 encoded chunks"""
+        chunk_size = chunk_size or self.chunk_size
+        chunk_size -= chunk_size % 3
+        with self.fs.open(self._filename(blob), 'rb') as f:
+            while 1:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield b64encode(chunk)
+
+    def read_base64(self, blob):
+        """Read a blob as base64"""
+        return b''.join(self.iter_base64(blob))
+
+    def stream_base64(self, blob):
+        """Get a JSON string that reads a blob as base64 when it is encoded"""
+        if not self.fs.exists(self._filename(blob)):
+            raise ResourceNotFoundError(self._filename(blob))
+        return StreamString(self.iter_base64, blob, raw=True)
+
+    def remove(self, blob):
+        filename = blob if blob.endswith('.tmp') else self._filename(blob)
+        try:
+            self.fs.remove(filename)
+        except FSError:
+            pass
+
+
 class TimelineManager(object):
     """Manages a collection of timelines"""
 
     def __init__(self, path):
         self.path = path
         self.timelines = {}
+        self._compactor_thread = None
+        self._compactor_stop = ThreadEvent()
 
     def __nonzero__(self):
         return bool(self.timelines)
@@ -171,14 +321,99 @@ class TimelineManager(object):
 
         for section, name in conf.qualified_sections('timeline'):
             max_events = conf.get(section, 'max_events', None)
-            timeline_manager.new_timeline(name, max_events=max_events)
+            if max_events is not None:
+                max_events = conf.get_integer(section, 'max_events')
+            segment_size = conf.get_integer(section, 'segment_size', 1024 * 1024)
+            upload_blobs = conf.get_bool(section, 'upload_blobs', False)
+            codec = conf.get(section, 'codec', 'json')
+            if codec not in eventcodecs.get_codec_names():
+                raise errors.ConfigError("[{}]/codec must be one of {}".format(section, ", ".join(eventcodecs.get_codec_names())))
+            timeline = timeline_manager.new_timeline(name,
+                                                     max_events=max_events,
+                                                     segment_size=segment_size,
+                                                     upload_blobs=upload_blobs,
+                                                     codec=codec)
+            timeline.sync_max_events = conf.get_integer(section, 'sync_max_events', 500)
+            timeline.sync_max_bytes = conf.get_integer(section, 'sync_max_bytes', 4 * 1024 * 1024)
+            timeline.sync_chunks = max(1, conf.get_integer(section, 'sync_chunks', 4))
+
+            if conf.get(section, 'max_bytes', None) is not None:
+                timeline.max_bytes = conf.get_integer(section, 'max_bytes')
+            if conf.get(section, 'max_age', None) is not None:
+                timeline.max_age = conf.get_float(section, 'max_age')
+            timeline.retention = conf.get(section, 'retention', 'reject')
+            if timeline.retention not in Timeline.retention_policies:
+                raise errors.ConfigError("[{}]/retention must be one of {}".format(section, ", ".join(Timeline.retention_policies)))
+            timeline.downsample = conf.get_integer(section, 'downsample', 2)
+            if timeline.downsample < 2:
+                raise errors.ConfigError("[{}]/downsample must be 2 or more".format(section))
+
+            image_workers = conf.get_integer(section, 'image_workers', 0)
+            if image_workers:
+                try:
+                    max_size = conf.get(section, 'image_max_size', None)
+                    max_size = max_size and parse_size(max_size)
+                    thumbnail_size = conf.get(section, 'image_thumbnail', None)
+                    thumbnail_size = thumbnail_size and parse_size(thumbnail_size)
+                except ValueError as e:
+                    raise errors.ConfigError("[{}] {}".format(section, e))
+                quality = conf.get(section, 'image_quality', None)
+                if quality is not None:
+                    quality = conf.get_integer(section, 'image_quality')
+                timeline.images = ImagePipeline(workers=image_workers,
+                                                queue_size=conf.get_integer(section, 'image_queue', 8),
+                                                max_size=max_size,
+                                                quality=quality,
+                                                thumbnail_size=thumbnail_size)
+
+        if any(timeline.needs_compaction for timeline in timeline_manager):
+            timeline_manager.start_compactor(conf.get_float('timelines', 'compact_interval', 10.0))
         return timeline_manager
 
-    def new_timeline(self, name, max_events=None):
+    def new_timeline(self, name, max_events=None, segment_size=1024 * 1024, upload_blobs=False, codec='json'):
         """Create a new timeline and store it"""
         path = os.path.join(self.path, name)
-        timeline = Timeline(path, name, max_events=max_events)
+        timeline = Timeline(path,
+                            name,
+                            max_events=max_events,
+                            segment_size=segment_size,
+                            upload_blobs=upload_blobs,
+                            codec=codec)
         self.timelines[timeline.name] = timeline
+        return timeline
+
+    def start_compactor(self, interval=10.0):
+        """Start a background thread that enforces retention limits every `interval` seconds"""
+        if self._compactor_thread is not None:
+            return
+        self._compactor_stop.clear()
+        self._compactor_thread = Thread(target=self._run_compactor,
+                                        args=(interval,),
+                                        name="timeline compactor")
+        self._compactor_thread.daemon = True
+        self._compactor_thread.start()
+
+    def _run_compactor(self, interval):
+        while not self._compactor_stop.wait(interval):
+            for timeline in self.timelines.values():
+                if not timeline.needs_compaction:
+                    continue
+                try:
+                    dropped = timeline.compact()
+                except Exception:
+                    log.exception("error compacting timeline '{}'".format(timeline.name))
+                else:
+                    if dropped:
+                        log.debug("dropped {} event(s) from timeline '{}'".format(dropped, timeline.name))
+
+    def close(self):
+        """Stop the compactor and close all timelines"""
+        if self._compactor_thread is not None:
+            self._compactor_stop.set()
+            self._compactor_thread.join()
+            self._compactor_thread = None
+        for timeline in self.timelines.itervalues():
+            timeline.close()
 
     def get_timeline(self, timeline_name):
         try:
@@ -190,22 +425,412 @@ class TimelineManager(object):
 
 
 class Timeline(object):
-    """A timeline is a sequence of timestamped events."""
+    """A timeline is a sequence of timestamped events.
+
+    Events are appended to segment files (``NNNNNNNN.log``) as length prefixed records, encoded
+    with the timeline's codec (see `dataplicity.client.eventcodecs`), and a new segment is
+    started when the current one reaches `segment_size` bytes. An append-only index
+    (``events.idx``) stores the position, timestamp, type and id of each record, so events can be
+    listed without reading the segments.
+
+    Each record has a sequence number made from its segment number and its ordinal within the
+    segment. Events cleared after a sync are recorded in ``acks.bin``, which stores a watermark
+    (every record before it is acknowledged) and a bitmap of later acknowledged records for each
+    segment, so clearing any number of events is a single small write. Segments are deleted in
+    bulk, in the background, once every event in them has been acknowledged.
+
+    Attachments are stored as raw files in a ``blobs`` directory named by their SHA1, and
+    referenced from the event record. Blobs are reference counted, so an attachment that is
+    identical to an earlier one is stored once, and deleted when the last event that uses it is
+    cleared. They are base64 encoded (in chunks) when events are read for syncing.
+
+    Events may be added by other processes (such as the ``dataplicity event`` command). Each
+    process appends to a segment it created, and `get_events` indexes records appended to other
+    segments since they were last read.
+
+    """
 
-    def __init__(self, path, name, max_events=None):
+    record_struct = struct.Struct(b'<I')
+    retention_policies = ('reject', 'drop_oldest', 'downsample')
+    # Maximum number of events dropped by each call to `compact`
+    compact_batch = 1000
+    index_filename = 'events.idx'
+    acks_filename = 'acks.bin'
+    acks_header = "timeline acks v1\n"
+    acks_struct = struct.Struct(b'<QII')
+
+    def __init__(self, path, name, max_events=None, segment_size=1024 * 1024, upload_blobs=False, codec='json'):
         self.path = path
         self.name = name
+        # Codec used to write new records, existing records may use any codec
+        self.codec = eventcodecs.get_codec(codec)
+        # Send each blob once per sync, rather than inline in every attachment
+        self.upload_blobs = upload_blobs
+        # Optional ImagePipeline used by `new_photo`
+        self.images = None
+        # Retention limits (None for no limit), and the policy used when they are exceeded
+        self.max_bytes = None
+        self.max_age = None
+        self.retention = 'reject'
+        self.downsample = 2
+        # Limits for each chunk of events sent when syncing (None for no limit), and the number of chunks per sync
+        self.sync_max_events = None
+        self.sync_max_bytes = None
+        self.sync_chunks = 1
         self.fs = OSFS(path, create=True)
+        self.blobs = BlobStore(os.path.join(path, 'blobs'))
         self.max_events = max_events
+        self.segment_size = segment_size
+        self.lock = RLock()
+
+        # Maps event id on to an index entry
+        # (seq, segment, offset, length, timestamp, event type, event id, attachment size, blobs)
+        self._index = {}
+        # Index entries for acknowledged events in segments that haven't been deleted yet
+        self._acked_entries = {}
+        # Maps segment number on to the number of unacknowledged events
+        self._segment_events = {}
+        # Maps segment number on to the offset at the end of the indexed records
+        self._segment_ends = {}
+        # Maps segment number on to the number of indexed records
+        self._segment_records = {}
+        # Maps segment number on to a list of [watermark, set of acknowledged ordinals >= watermark]
+        self._acks = {}
+        # Number of bytes used by unacknowledged events, including attachments
+        self._bytes = 0
+        # Oldest and newest unacknowledged timestamps, or None if they must be recalculated
+        self._time_range = None
+        # Sorted list of (timestamp, seq, event id), built on demand
+        self._time_order = None
+        # True if the time order contains acknowledged events
+        self._time_order_dirty = False
+        self._segment = 0
+        self._segment_end = 0
+        self._file = None
+        self._reclaim_thread = None
+        # Maps blob name on to the number of unacknowledged (or unwritten) events that reference it
+        self._blob_refs = {}
+        # Blobs that are no longer referenced, deleted by `reclaim`
+        self._unreferenced_blobs = set()
+        # Held while a blob file is written or deleted, so `reclaim` needn't hold the timeline lock
+        self._blob_lock = RLock()
+
+        self._load()
+        self._migrate_json()
 
     def __repr__(self):
         return "Timeline({!r}, {!r}, max_events={!r})".format(self.path, self.name, self.max_events)
 
+    def _segment_filename(self, segment):
+        return "{:08d}.log".format(segment)
+
+    def _list_segments(self):
+        return sorted(int(filename[:-4]) for filename in self.fs.listdir(wildcard="*.log")
+                      if filename[:-4].isdigit())
+
+    def _read_lines(self, filename):
+        if not self.fs.exists(filename):
+            return []
+        with self.fs.open(filename, 'rb') as f:
+            return f.read().splitlines()
+
+    def _load(self):
+        """Load the index and acknowledged events, and index any records missing from the index"""
+        segments = self._list_segments()
+        self._read_acks()
+
+        segment_sizes = {}
+        for segment in segments:
+            self._segment_events[segment] = 0
+            self._segment_ends[segment] = 0
+            self._segment_records[segment] = 0
+            segment_sizes[segment] = self.fs.getsize(self._segment_filename(segment))
+        for line in self._read_lines(self.index_filename):
+            try:
+                entry = tuple(loads(line))
+            except ValueError:
+                # Partially written line
+                continue
+            seq, segment, offset, length = entry[:4]
+            if segment not in self._segment_events or entry[6] in self._index:
+                continue
+            if offset + length > segment_sizes[segment]:
+                # The segment was truncated after the record was indexed
+                continue
+            self._segment_ends[segment] = max(self._segment_ends[segment], offset + length)
+            self._segment_records[segment] = max(self._segment_records[segment], (seq & 0xffffffff) + 1)
+            self._load_entry(entry)
+
+        # Always start a new segment, in case the last one ends with a partial record
+        self._segment = (segments[-1] + 1) if segments else 0
+        self._refresh()
+        self.reclaim()
+        self._collect_blobs()
+
+    def _load_entry(self, entry):
+        """Add an index entry read from disk"""
+        if self._is_acked(entry[0]):
+            self._acked_entries[entry[6]] = entry
+        else:
+            self._add_entry(entry)
+
+    def _refresh(self):
+        """Index records that aren't in the index, i.e. written by another process, or before a crash"""
+        recovered = []
+        for segment in self._list_segments():
+            if segment == self._segment and self._file is not None:
+                continue
+            recovered.extend(self._index_records(segment))
+        if recovered:
+            log.debug("indexed {} event(s) in timeline '{}'".format(len(recovered), self.name))
+            self._append_index(recovered)
+
+    def _index_records(self, segment):
+        """Index the records in a segment after the last indexed record, and return the new entries"""
+        self._segment_events.setdefault(segment, 0)
+        recovered = []
+        for entry in self._scan_segment(segment, self._segment_ends.get(segment, 0)):
+            event_id = entry[6]
+            if event_id in self._index or event_id in self._acked_entries:
+                continue
+            self._load_entry(entry)
+            recovered.append(entry)
+        return recovered
+
+    @classmethod
+    def _make_seq(cls, segment, ordinal):
+        return (segment << 32) | ordinal
+
+    def _is_acked(self, seq):
+        ack = self._acks.get(seq >> 32)
+        if ack is None:
+            return False
+        ordinal = seq & 0xffffffff
+        return ordinal < ack[0] or ordinal in ack[1]
+
+    def _ack(self, seq):
+        ack = self._acks.get(seq >> 32)
+        if ack is None:
+            ack = self._acks[seq >> 32] = [0, set()]
+        watermark, acked = ack
+        acked.add(seq & 0xffffffff)
+        while watermark in acked:
+            acked.remove(watermark)
+            watermark += 1
+        ack[0] = watermark
+
+    def _read_acks(self):
+        """Read the watermark and bitmap of acknowledged records for each segment"""
+        self._acks.clear()
+        if not self.fs.exists(self.acks_filename):
+            return
+        with self.fs.open(self.acks_filename, 'rb') as f:
+            if f.readline() != self.acks_header:
+                log.warning("unrecognized acks file in timeline '{}'".format(self.name))
+                return
+            data = f.read()
+        pos = 0
+        acks_size = self.acks_struct.size
+        while pos + acks_size <= len(data):
+            segment, watermark, bitmap_size = self.acks_struct.unpack_from(data, pos)
+            pos += acks_size
+            bitmap = bytearray(data[pos:pos + bitmap_size])
+            pos += bitmap_size
+            self._acks[segment] = [watermark, set(watermark + byte_no * 8 + bit
+                                                  for byte_no, byte in enumerate(bitmap) if byte
+                                                  for bit in xrange(8) if byte & (1 << bit))]
+
+    def _write_acks(self):
+        """Persist acknowledged records"""
+        with atomicwrite.open(self.fs.getsyspath(self.acks_filename), 'wb') as f:
+            f.write(self.acks_header)
+            for segment, (watermark, acked) in sorted(self._acks.items()):
+                bitmap = bytearray((max(acked) - watermark) // 8 + 1 if acked else 0)
+                for ordinal in acked:
+                    bit = ordinal - watermark
+                    bitmap[bit // 8] |= 1 << (bit % 8)
+                f.write(self.acks_struct.pack(segment, watermark, len(bitmap)))
+                f.write(bytes(bitmap))
+
+    def _scan_segment(self, segment, offset):
+        """Read index entries from a segment, starting at `offset`"""
+        entries = []
+        header_size = self.record_struct.size
+        ordinal = self._segment_records.get(segment, 0)
+        with self.fs.open(self._segment_filename(segment), 'rb') as f:
+            f.seek(offset)
+            while 1:
+                header = f.read(header_size)
+                if len(header) < header_size:
+                    break
+                length, = self.record_struct.unpack(header)
+                record = f.read(length)
+                if len(record) < length:
+                    break
+                try:
+                    event = eventcodecs.decode_record(record)
+                except (ValueError, eventcodecs.CodecError, zlib.error):
+                    log.warning("unreadable event in timeline '{}' segment {}".format(self.name, segment))
+                else:
+                    entries.append((self._make_seq(segment, ordinal),
+                                    segment,
+                                    offset,
+                                    header_size + length,
+                                    event['timestamp'],
+                                    event['event_type'],
+                                    event['event_id'],
+                                    self._attachment_size(event),
+                                    self._attachment_blobs(event)))
+                ordinal += 1
+                offset += header_size + length
+        self._segment_ends[segment] = offset
+        self._segment_records[segment] = ordinal
+        return entries
+
+    def _append_index(self, entries):
+        with self.fs.open(self.index_filename, 'ab') as f:
+            f.write(''.join(dumps(list(entry), separators=(',', ':')) + '\n' for entry in entries))
+
+    def _migrate_json(self):
+        """Move events stored as individual JSON files (by previous versions) in to the log"""
+        filenames = self.fs.listdir(wildcard="*.json")
+        if not filenames:
+            return
+        events = []
+        for filename in filenames:
+            try:
+                with self.fs.open(filename, 'rb') as f:
+                    events.append(loads(f.read()))
+            except (FSError, ValueError):
+                log.exception("unable to migrate timeline event '{}'".format(filename))
+        events.sort(key=itemgetter('timestamp'))
+        with self.lock:
+            entries = [self._append_event(event) for event in events]
+            self._flush()
+            self._append_index(entries)
+        for filename in filenames:
+            try:
+                self.fs.remove(filename)
+            except FSError:
+                pass
+        log.debug("migrated {} event(s) in timeline '{}'".format(len(events), self.name))
+
+    def _open_segment(self):
+        if self._file is None:
+            if not self._segment_end:
+                # Create a new segment that no other process is writing to
+                while 1:
+                    try:
+                        fd = os.open(self.fs.getsyspath(self._segment_filename(self._segment)),
+                                     os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                        self._segment += 1
+                    else:
+                        os.close(fd)
+                        break
+            filename = self._segment_filename(self._segment)
+            self._file = self.fs.open(filename, 'ab')
+            self._segment_end = self.fs.getsize(filename)
+            if self._segment_end != self._segment_ends.get(self._segment, 0):
+                # Ordinals must continue from the records in the file, so index any we haven't seen
+                recovered = self._index_records(self._segment)
+                if recovered:
+                    self._append_index(recovered)
+        return self._file
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def _append_event(self, event):
+        """Append an event (as a dict) to the current segment and index it"""
+        if self._segment_end >= self.segment_size:
+            self._close_segment()
+            self._segment += 1
+            # The next segment is created exclusively, in case another process has started it
+            self._segment_end = 0
+        f = self._open_segment()
+        record = eventcodecs.encode_record(self.codec, event)
+        f.write(self.record_struct.pack(len(record)))
+        f.write(record)
+        ordinal = self._segment_records.get(self._segment, 0)
+        entry = (self._make_seq(self._segment, ordinal),
+                 self._segment,
+                 self._segment_end,
+                 self.record_struct.size + len(record),
+                 event['timestamp'],
+                 event['event_type'],
+                 event['event_id'],
+                 self._attachment_size(event),
+                 self._attachment_blobs(event))
+        self._segment_records[self._segment] = ordinal + 1
+        self._segment_end += entry[3]
+        self._segment_ends[self._segment] = self._segment_end
+        self._add_entry(entry)
+        return entry
+
+    @classmethod
+    def _attachment_size(cls, event):
+        return sum(attachment.get('size', 0) for attachment in event.get('attachments', []))
+
+    @classmethod
+    def _attachment_blobs(cls, event):
+        return [attachment['blob'] for attachment in event.get('attachments', []) if 'blob' in attachment]
+
+    def _add_entry(self, entry):
+        """Add an entry for an unacknowledged event, and update the stats"""
+        self._index[entry[6]] = entry
+        segment = entry[1]
+        self._segment_events[segment] = self._segment_events.get(segment, 0) + 1
+        self._bytes += entry[3] + entry[7]
+        self._ref_blobs(entry[8])
+        if self._time_order is not None:
+            key = (entry[4], entry[0], entry[6])
+            if not self._time_order or key > self._time_order[-1]:
+                self._time_order.append(key)
+            else:
+                insort(self._time_order, key)
+        if self._time_range is not None:
+            oldest, newest = self._time_range
+            self._time_range = (min(oldest, entry[4]), max(newest, entry[4]))
+        elif len(self._index) == 1:
+            self._time_range = (entry[4], entry[4])
+
+    def __len__(self):
+        return len(self._index)
+
+    def stats(self):
+        """Get a dict of statistics for unacknowledged events (count, bytes, oldest, newest)"""
+        with self.lock:
+            if self._time_range is None and self._index:
+                timestamps = [entry[4] for entry in self._index.itervalues()]
+                self._time_range = (min(timestamps), max(timestamps))
+            oldest, newest = self._time_range or (None, None)
+            return {"count": len(self._index),
+                    "bytes": self._bytes,
+                    "oldest": oldest,
+                    "newest": newest}
+
+    @property
+    def needs_compaction(self):
+        """Check if retention limits are enforced by `compact`, rather than when adding events"""
+        if self.max_age is not None:
+            return True
+        return self.retention != 'reject' and (self.max_events is not None or self.max_bytes is not None)
+
     def new_event(self, event_type, timestamp=None, *args, **kwargs):
         """Create and return an event, to be used as a context manager"""
-        if self.max_events is not None:
-            size = len(self.fs.listdir(wildcard="*.json"))
-            if size >= self.max_events:
+        if self.retention == 'reject':
+            if self.max_events is not None and len(self) >= self.max_events:
+                raise TimelineFullError("The timeline has reached its maximum size")
+            if self.max_bytes is not None and self._bytes >= self.max_bytes:
                 raise TimelineFullError("The timeline has reached its maximum size")
 
         if timestamp is None:
@@ -226,57 +851,363 @@ class Timeline(object):
         """Create a new photo object"""
         event = self.new_event('IMAGE', **kwargs)
 
+        if self.images is not None:
+            # Processing and writing happens in the image pipeline
+            if hasattr(file, 'getvalue'):
+                data = file.getvalue()
+            elif isinstance(file, basestring):
+                with open(file, 'rb') as f:
+                    data = f.read()
+            elif file is not None:
+                data = file.read()
+            else:
+                raise ValueError("A value for 'file' is required")
+            event.set_image(data, filename=filename, ext=ext)
+            return event
+
         if hasattr(file, 'getvalue'):
-            bytes = file.getvalue()
+            event.attach_bytes(file.getvalue(), name='photo', filename=filename, ext=ext)
         elif file is not None:
             if isinstance(file, basestring):
                 with open(file, 'rb') as f:
-                    bytes = f.read()
+                    event.attach_stream(f, name='photo', filename=filename, ext=ext)
             else:
-                bytes = file.read()
+                event.attach_stream(file, name='photo', filename=filename, ext=ext)
         else:
-            if bytes is None:
-                raise ValueError("A value for 'file' or 'bytes' is required")
-        event.attach_bytes(bytes, name='photo', filename=filename, ext=ext)
+            raise ValueError("A value for 'file' is required")
         return event
 
-    def get_events(self, sort=True):
-        """Get all accumulated events"""
-        events = []
-        for event_filename in self.fs.listdir(wildcard="*.json"):
-            with self.fs.open(event_filename, 'rb') as f:
-                event = loads(f.read())
-                events.append(event)
-        if sort:
-            # sort by timestamp
-            events.sort(key=itemgetter('timestamp'))
-        return events
+    def _read_entries(self, entries):
+        """Read the events for a list of index entries, in the same order"""
+        events = {}
+        by_segment = {}
+        for entry in entries:
+            by_segment.setdefault(entry[1], []).append(entry)
+        header_size = self.record_struct.size
+        for segment, segment_entries in sorted(by_segment.items()):
+            # Read each segment sequentially
+            segment_entries.sort(key=itemgetter(2))
+            with self.fs.open(self._segment_filename(segment), 'rb') as f:
+                for entry in segment_entries:
+                    seq, _segment, offset, length = entry[:4]
+                    f.seek(offset + header_size)
+                    events[seq] = eventcodecs.decode_record(f.read(length - header_size))
+        return [events[entry[0]] for entry in entries]
+
+    def _get_time_order(self):
+        """Get a list of (timestamp, seq, event id) for unacknowledged events, in time order"""
+        if self._time_order is None:
+            self._time_order = sorted((entry[4], entry[0], entry[6]) for entry in self._index.itervalues())
+        elif self._time_order_dirty:
+            index = self._index
+            self._time_order = [key for key in self._time_order if key[2] in index]
+        self._time_order_dirty = False
+        return self._time_order
+
+    def _get_event_key(self, event_id):
+        """Get the position of an event in time order, which may have been acknowledged"""
+        entry = self._index.get(event_id) or self._acked_entries.get(event_id)
+        if entry is not None:
+            return (entry[4], entry[0], entry[6])
+        # Event ids contain the timestamp, which is enough to continue paginating
+        try:
+            timestamp = int(event_id.split('_')[-2])
+        except (IndexError, ValueError):
+            raise UnknownEventError("No event '{}'".format(event_id))
+        return (timestamp, float('inf'))
+
+    def get_events(self,
+                   sort=True,
+                   inline_blobs=True,
+                   since=None,
+                   until=None,
+                   event_types=None,
+                   limit=None,
+                   after_id=None,
+                   max_bytes=None,
+                   lazy_blobs=False):
+        """Get accumulated events, in timestamp order.
+
+        `since` and `until` select events where since <= timestamp < until (in milliseconds),
+        `event_types` is a list of event types to return, and `after_id` returns only events after
+        a given event id, which may be used to page through a timeline. `limit` and `max_bytes`
+        limit the number and size of events returned. The size of events (including attachments)
+        is measured before base64 encoding, and at least one event is returned even if it is
+        larger than `max_bytes`. If `sort` is False, the selected events are returned in the order
+        they were written.
+
+        If `inline_blobs` is True, attachments contain their base64 encoded data. Otherwise they
+        reference a blob by name, and the data may be retrieved with `get_blobs`. If `lazy_blobs`
+        is True, inlined data is a `jsonstream.StreamString`, which reads the blob when the event is
+        encoded with `jsonstream`, so attachments needn't be held in memory.
+
+        Events are selected from the index, so only the returned events are decoded.
+
+        """
+        if event_types is not None:
+            event_types = set(event_types)
+        with self.lock:
+            self._flush()
+            self._refresh()
+            order = self._get_time_order()
+            start = 0
+            end = len(order)
+            if since is not None:
+                start = bisect_left(order, (since,))
+            if after_id is not None:
+                start = max(start, bisect_right(order, self._get_event_key(after_id)))
+            if until is not None:
+                end = bisect_left(order, (until,))
+            index = self._index
+            entries = []
+            for key in islice(order, start, end):
+                entry = index[key[2]]
+                if event_types is not None and entry[5] not in event_types:
+                    continue
+                entries.append(entry)
+                if limit is not None and len(entries) >= limit:
+                    break
+            if not sort:
+                entries.sort()
+            if max_bytes is not None:
+                size = 0
+                for count, entry in enumerate(entries):
+                    size += entry[3] + entry[7]
+                    if size > max_bytes and count:
+                        entries = entries[:count]
+                        break
+            events = self._read_entries(entries)
+            if inline_blobs:
+                blob_cache = {}
+                for event in events:
+                    self._inline_attachments(event, blob_cache, lazy_blobs)
+            return events
+
+    def _inline_attachments(self, event, blob_cache, lazy=False):
+        """Replace blob references in an event with base64 encoded data"""
+        attachments = []
+        for attachment in event.get('attachments', []):
+            blob = attachment.pop('blob', None)
+            if blob is not None:
+                attachment.pop('size', None)
+                data = blob_cache.get(blob)
+                if data is None:
+                    try:
+                        if lazy:
+                            data = blob_cache[blob] = self.blobs.stream_base64(blob)
+                        else:
+                            data = blob_cache[blob] = self.blobs.read_base64(blob)
+                    except FSError:
+                        log.warning("missing attachment for event '{}'".format(event['event_id']))
+                        continue
+                attachment['data'] = data
+            attachments.append(attachment)
+        event['attachments'] = attachments
+
+    def get_blobs(self, events, lazy=False):
+        """Get a dict that maps the blobs referenced in `events` on to base64 encoded data.
+
+        If `lazy` is True, the data is a `jsonstream.StreamString` (see `get_events`).
+
+        """
+        blobs = {}
+        for event in events:
+            for attachment in event.get('attachments', []):
+                blob = attachment.get('blob')
+                if blob is not None and blob not in blobs:
+                    try:
+                        if lazy:
+                            blobs[blob] = self.blobs.stream_base64(blob)
+                        else:
+                            blobs[blob] = self.blobs.read_base64(blob)
+                    except FSError:
+                        log.warning("missing attachment for event '{}'".format(event['event_id']))
+        return blobs
+
+    def _write_blob(self, data):
+        """Store a string or file-like object in a blob, and reference it until an event is written"""
+        with self.lock, self._blob_lock:
+            if isinstance(data, basestring):
+                blob, size = self.blobs.write_bytes(data)
+            else:
+                blob, size = self.blobs.write_stream(data)
+            self._ref_blobs([blob])
+        return blob, size
+
+    def _ref_blobs(self, blobs):
+        for blob in blobs:
+            self._blob_refs[blob] = self._blob_refs.get(blob, 0) + 1
+
+    def _release_blobs(self, blobs):
+        """Remove a reference to blobs, blobs that are no longer referenced are deleted by `reclaim`"""
+        with self.lock:
+            for blob in blobs:
+                refs = self._blob_refs.get(blob, 0) - 1
+                if refs > 0:
+                    self._blob_refs[blob] = refs
+                else:
+                    self._blob_refs.pop(blob, None)
+                    self._unreferenced_blobs.add(blob)
+
+    def _collect_blobs(self, min_age=60 * 60):
+        """Delete blobs that aren't referenced by any event.
+
+        Blobs newer than `min_age` seconds are kept, since they may belong to an event that another
+        process hasn't written yet.
+
+        """
+        now = time()
+        for blob, modified_time in self.blobs.list_blobs():
+            if blob not in self._blob_refs and now - modified_time > min_age:
+                self.blobs.remove(blob)
 
     def clear_all(self):
         """Clear all stored events"""
-        for filename in self.fs.listdir(wildcard="*.json"):
-            try:
-                self.fs.remove(filename)
-            except FSError:
-                pass
+        with self.lock:
+            self.clear_events(self._index.keys())
+
+    def compact(self):
+        """Drop events that exceed the retention limits, up to `compact_batch` at a time.
+
+        Returns the number of events dropped.
+
+        """
+        with self.lock:
+            self._refresh()
+            entries = self._index.values()
+            dropped = []
+            if self.max_age is not None:
+                # Timestamps are in milliseconds
+                oldest = (time() - self.max_age) * 1000.0
+                dropped = [entry for entry in entries if entry[4] < oldest]
+            if self.retention != 'reject':
+                excess_events = 0
+                if self.max_events is not None:
+                    excess_events = len(entries) - len(dropped) - self.max_events
+                excess_bytes = 0
+                if self.max_bytes is not None:
+                    excess_bytes = self._bytes - sum(entry[3] + entry[7] for entry in dropped) - self.max_bytes
+                if excess_events > 0 or excess_bytes > 0:
+                    dropped_ids = set(entry[6] for entry in dropped)
+                    candidates = [entry for entry in nsmallest(self.compact_batch * self.downsample,
+                                                               entries,
+                                                               key=itemgetter(4, 0))
+                                  if entry[6] not in dropped_ids]
+                    if self.retention == 'downsample':
+                        # Keep every Nth of the oldest events
+                        candidates = [entry for count, entry in enumerate(candidates)
+                                      if count % self.downsample]
+                    for entry in candidates:
+                        if excess_events <= 0 and excess_bytes <= 0:
+                            break
+                        dropped.append(entry)
+                        excess_events -= 1
+                        excess_bytes -= entry[3] + entry[7]
+            dropped = dropped[:self.compact_batch]
+            self._remove_events([entry[6] for entry in dropped])
+        return len(dropped)
 
     def clear_events(self, event_ids):
         """Clear any events that have been processed"""
-        for event_id in event_ids:
-            filename = "{}.json".format(event_id)
-            try:
+        self._remove_events(event_ids)
+
+    def _remove_events(self, event_ids):
+        """Acknowledge events, so they aren't synced, and may be deleted"""
+        with self.lock:
+            cleared = [event_id for event_id in event_ids if event_id in self._index]
+            if not cleared:
+                return
+            for event_id in cleared:
+                entry = self._acked_entries[event_id] = self._index.pop(event_id)
+                self._ack(entry[0])
+                self._segment_events[entry[1]] -= 1
+                self._bytes -= entry[3] + entry[7]
+            self._write_acks()
+            for event_id in cleared:
+                self._release_blobs(self._acked_entries[event_id][8])
+            self._time_range = None
+            self._time_order_dirty = True
+            if not self._segment_events.get(self._segment) and self._segment_end:
+                # Start a new segment, so the current one may be deleted
+                self._close_segment()
+                self._segment += 1
+                self._segment_end = 0
+            reclaimable = self._unreferenced_blobs or any(not count and segment != self._segment
+                                                          for segment, count in self._segment_events.iteritems())
+            if reclaimable and self._reclaim_thread is None:
+                self._reclaim_thread = Thread(target=self.reclaim, name="reclaim {}".format(self.name))
+                self._reclaim_thread.daemon = True
+                self._reclaim_thread.start()
+
+    def reclaim(self):
+        """Delete segments where every event has been acknowledged, and unreferenced blobs.
+
+        The timeline lock is only held to find what may be deleted, and to rewrite the index
+        afterwards, so events may be added while files are deleted.
+
+        """
+        with self.lock:
+            self._reclaim_thread = None
+            blobs = list(self._unreferenced_blobs)
+            self._unreferenced_blobs.clear()
+            segments = [segment for segment, count in sorted(self._segment_events.items())
+                        if not count and segment != self._segment]
+
+        for blob in blobs:
+            with self._blob_lock:
+                # The blob may have been written again since it was released
+                if blob not in self._blob_refs:
+                    self.blobs.remove(blob)
+        # A segment is forgotten only once its file is gone, otherwise its events would be re-indexed
+        removed = set(segment for segment in segments if self._remove_segment(segment))
+        if not removed:
+            return
+
+        with self.lock:
+            for segment in removed:
+                self._segment_events.pop(segment, None)
+                self._segment_ends.pop(segment, None)
+                self._segment_records.pop(segment, None)
+                self._acks.pop(segment, None)
+            for event_id, entry in self._acked_entries.items():
+                if entry[1] in removed:
+                    del self._acked_entries[event_id]
+            # Rewrite the index before the acks, so an acked event is never indexed without its ack
+            entries = sorted(self._index.values() + self._acked_entries.values())
+            with atomicwrite.open(self.fs.getsyspath(self.index_filename), 'wb') as f:
+                f.write(''.join(dumps(list(entry), separators=(',', ':')) + '\n' for entry in entries))
+            self._write_acks()
+
+    def _remove_segment(self, segment):
+        """Delete a segment file, return True if it no longer exists"""
+        filename = self._segment_filename(segment)
+        try:
+            if self.fs.exists(filename):
                 self.fs.remove(filename)
-            except FSError:
-                pass
+        except FSError:
+            log.exception("unable to remove timeline segment {}".format(segment))
+            return False
+        return True
+
+    def close(self):
+        """Write events in the image pipeline, and close the current segment"""
+        if self.images is not None:
+            self.images.close()
+            self.images = None
+        with self.lock:
+            self._close_segment()
 
     def _write_event(self, event_id, event):
         if hasattr(event, 'to_data'):
             event = event.to_data()
         event['event_id'] = event_id
-        event_json = dumps(event, indent=4)
-        filename = "{}.json".format(event_id)
-        with self.fs.open(filename, 'wb') as f:
-            f.write(event_json)
+        with self.lock:
+            if event_id in self._index:
+                # Already written
+                return
+            entry = self._append_event(event)
+            self._flush()
+            self._append_index([entry])
 
 
 if __name__ == "__main__":
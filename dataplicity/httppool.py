@@ -0,0 +1,249 @@
+"""
+A pool of persistent (keep-alive) HTTP/1.1 connections.
+
+Connections are returned to the pool once a response has been read, and reused for the next
+request to the same host, which saves a TCP connection and (for https) a TLS handshake per
+request. Idle connections are closed after `idle_timeout` seconds, and are checked before reuse,
+since the server may have closed them.
+
+Proxies are read from the environment (``http_proxy``, ``https_proxy`` and ``no_proxy``), as
+they are by urllib2. Requests for https urls are tunnelled through the proxy with CONNECT.
+
+"""
+
+import base64
+import httplib
+import select
+import socket
+import urllib
+from threading import Lock
+from time import time
+from urllib2 import HTTPError
+from urlparse import urlsplit
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+class ChunkedBody(object):
+    """A request body sent with chunked transfer encoding, as it is read from an iterable.
+
+    The first chunk is read up front and kept, so the request may be retried until more of the
+    iterable has been read.
+
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._first = next(self._chunks, b'')
+        self.started = False
+
+    def send(self, connection):
+        self._send_chunk(connection, self._first)
+        self.started = True
+        for chunk in self._chunks:
+            self._send_chunk(connection, chunk)
+        connection.send(b'0\r\n\r\n')
+
+    @classmethod
+    def _send_chunk(cls, connection, chunk):
+        # An empty chunk would end the body
+        if chunk:
+            connection.send(b'{:x}\r\n'.format(len(chunk)) + chunk + b'\r\n')
+
+
+class PooledResponse(object):
+    """A file-like HTTP response, which returns its connection to the pool when closed"""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self, size=None):
+        if size is None:
+            return self._response.read()
+        return self._response.read(size)
+
+    def readline(self):
+        return self._response.fp.readline() if self._response.fp is not None else b''
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        # The connection may only be reused if the whole response was read
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release(self._key, connection)
+        else:
+            self._response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ConnectionPool(object):
+    """Keeps up to `max_idle` idle connections per host, for up to `idle_timeout` seconds.
+
+    `proxies` maps a url scheme on to a proxy url, and defaults to the proxies in the environment.
+
+    """
+
+    def __init__(self, max_idle=2, idle_timeout=60, timeout=None, proxies=None):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        # Maps (scheme, host, proxy) on to a list of (connection, time released)
+        self._idle = {}
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<connectionpool {} idle>".format(sum(len(idle) for idle in self._idle.values()))
+
+    @classmethod
+    def _is_healthy(cls, connection):
+        """Check an idle connection is still open"""
+        sock = connection.sock
+        if sock is None:
+            return False
+        # There should be nothing to read on an idle connection, if it is readable then the
+        # server has closed it (or sent something unexpected)
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def _get_proxy(self, scheme, host):
+        """Get a tuple of (proxy host, proxy authorization header) for a host, or None for no proxy"""
+        proxy_url = self.proxies.get(scheme)
+        if not proxy_url or urllib.proxy_bypass(host.split(':')[0]):
+            return None
+        if '://' not in proxy_url:
+            proxy_url = 'http://' + proxy_url
+        proxy_host = urlsplit(proxy_url).netloc
+        authorization = None
+        if '@' in proxy_host:
+            credentials, proxy_host = proxy_host.rsplit('@', 1)
+            authorization = 'Basic ' + base64.b64encode(urllib.unquote(credentials))
+        return proxy_host, authorization
+
+    def _get_connection(self, key):
+        """Get an idle connection, or a new connection. Returns a tuple of (connection, reused)"""
+        now = time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, released = idle.pop()
+                if now - released < self.idle_timeout and self._is_healthy(connection):
+                    return connection, True
+                connection.close()
+        scheme, host, proxy = key
+        connection_cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        if proxy is None:
+            return connection_cls(host, timeout=self.timeout), False
+        proxy_host, authorization = proxy
+        connection = connection_cls(proxy_host, timeout=self.timeout)
+        if scheme == 'https':
+            # Connect to the host through the proxy, the request is then sent as usual
+            tunnel_headers = {'Proxy-Authorization': authorization} if authorization else None
+            connection.set_tunnel(host, headers=tunnel_headers)
+        return connection, False
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if self.idle_timeout > 0 and len(idle) < self.max_idle:
+                idle.append((connection, time()))
+                return
+        connection.close()
+
+    @classmethod
+    def _request(cls, connection, method, selector, data, headers):
+        if not isinstance(data, ChunkedBody):
+            if hasattr(data, 'read'):
+                data.seek(0)
+            connection.request(method, selector, data, headers)
+            return
+        header_names = set(name.lower() for name in headers)
+        connection.putrequest(method,
+                              selector,
+                              skip_host='host' in header_names,
+                              skip_accept_encoding='accept-encoding' in header_names)
+        for name, value in headers.iteritems():
+            connection.putheader(name, value)
+        connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        data.send(connection)
+
+    def open(self, url, data=None, headers=None):
+        """Send a request (a POST if `data` is given, otherwise a GET), and return the response.
+
+        `data` may be a string, a seekable file (with a Content-Length header), or an iterable
+        of strings, which is sent with chunked transfer encoding.
+
+        Raises `urllib2.HTTPError` for error responses, as `urllib2.urlopen` does.
+
+        """
+        scheme, host, path, query, _fragment = urlsplit(url)
+        if scheme not in ('http', 'https'):
+            raise ValueError("unsupported url scheme '{}'".format(scheme))
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        proxy = self._get_proxy(scheme, host)
+        key = (scheme, host, proxy)
+        method = 'GET' if data is None else 'POST'
+        headers = dict(headers or {})
+        if proxy is not None and scheme == 'http':
+            # A plain http proxy expects the full url in the request line
+            selector = '{}://{}{}'.format(scheme, host, selector)
+            if proxy[1]:
+                headers['Proxy-Authorization'] = proxy[1]
+        if not (data is None or isinstance(data, basestring) or hasattr(data, 'read')):
+            data = ChunkedBody(data)
+
+        while 1:
+            connection, reused = self._get_connection(key)
+            sent = False
+            try:
+                self._request(connection, method, selector, data, headers)
+                sent = True
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # A POST may have been processed once it was sent, so only a GET is sent again
+                retry = method == 'GET' or not (sent or getattr(data, 'started', False))
+                if reused and retry:
+                    # The server closed the connection while it was idle, try another
+                    log.debug("connection to {} closed by server, reconnecting".format(host))
+                    continue
+                raise
+            break
+
+        pooled_response = PooledResponse(self, key, connection, response)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.msg, pooled_response)
+        return pooled_response
+
+    def close(self):
+        """Close idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, _released in idle:
+                    connection.close()
+            self._idle.clear()
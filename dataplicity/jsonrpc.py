@@ -1,5 +1,11 @@
-import urllib
+from dataplicity.httppool import ConnectionPool
+from dataplicity import jsonstream
+
+from urllib2 import HTTPError
+from tempfile import SpooledTemporaryFile
+from itertools import chain
 import json
+import zlib
 
 
 class ProtocolError(Exception):
@@ -131,29 +137,119 @@ class Batch(object):
             raise KeyError("No such call_id in response")
 
 
+def iter_compress(chunks, encoding, level=6):
+    """Compress an iterable of chunks with a HTTP content encoding ('gzip' or 'deflate')"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError("unknown content encoding '{}'".format(encoding))
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress(data, encoding):
+    """Decompress data with a HTTP content encoding"""
+    if not encoding or encoding == 'identity':
+        return data
+    try:
+        if encoding == 'gzip':
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Some servers send deflate data without the zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise ProtocolError("unable to decode response ({})".format(e))
+    raise ProtocolError("unsupported content encoding '{}'".format(encoding))
+
+
 class JSONRPC(object):
-    """A client for a JSONRPC server"""
+    """A client for a JSONRPC server
+
+    If `compress` is 'gzip' or 'deflate', request bodies larger than `compress_min_size` are
+    compressed with that encoding. Compressed responses are always accepted.
+
+    Requests are encoded (and compressed) incrementally, and params may contain generators
+    and `jsonstream.StreamString` values. Larger requests are written to a temporary file
+    (which is kept in memory up to `spool_size` bytes) so the length is known before sending,
+    or if `chunked` is True, sent as they are encoded with chunked transfer encoding, which
+    requires server support.
+
+    Requests are sent over keep-alive connections from `pool`, which may be shared with other
+    clients (a pool is created if not supplied).
+
+    """
 
     unknown_error_msg = "the server did not supply further information"
+    encodings = ('gzip', 'deflate')
+    compress_min_size = 512
+    spool_size = 1024 * 1024
 
-    def __init__(self, url):
+    def __init__(self, url, compress=None, compress_level=6, pool=None, chunked=False):
+        if compress is not None and compress not in self.encodings:
+            raise ValueError("compress should be one of {}".format(", ".join(self.encodings)))
         self.url = url
+        self.compress = compress
+        self.compress_level = compress_level
+        self.pool = pool or ConnectionPool()
+        self.chunked = chunked
         self.call_id = 1
 
     def new_call_id(self):
         self.call_id += 1
         return self.call_id
 
+    def _encode(self, call, headers):
+        """Encode a call, returns a string for small calls, or a file or iterable for large calls"""
+        chunks = jsonstream.iterencode(call)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= self.compress_min_size:
+                break
+        else:
+            return head
+        body = chain([head], chunks)
+        if self.compress:
+            body = iter_compress(body, self.compress, self.compress_level)
+            headers["Content-Encoding"] = self.compress
+        if self.chunked:
+            return body
+        spool = SpooledTemporaryFile(max_size=self.spool_size)
+        for chunk in body:
+            spool.write(chunk)
+        headers["Content-Length"] = str(spool.tell())
+        spool.seek(0)
+        return spool
+
     def _send(self, call):
-        call_json = json.dumps(call)
+        headers = {"Content-Type": "application/json",
+                   "Accept-Encoding": ", ".join(self.encodings)}
+        body = self._encode(call, headers)
         url_file = None
         try:
-            url_file = urllib.urlopen(self.url, call_json)
+            try:
+                url_file = self.pool.open(self.url, body, headers)
+            except HTTPError as e:
+                # The body of an error response may still contain a JSONRPC error
+                if e.fp is None:
+                    raise
+                url_file = e
             response_json = url_file.read()
+            encoding = url_file.info().get('Content-Encoding', '').strip().lower()
         finally:
             if url_file is not None:
                 url_file.close()
-        return response_json
+            if hasattr(body, 'close'):
+                body.close()
+        return decompress(response_json, encoding)
 
     def call(self, method, **params):
         """Call a remote method"""
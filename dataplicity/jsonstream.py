@@ -0,0 +1,117 @@
+"""
+Encode JSON incrementally.
+
+`iterencode` yields the JSON for an object in chunks, so a large request may be compressed and
+sent as it is encoded, rather than building the whole document in memory. As well as the types
+supported by the json module, any other iterable (such as a generator) is encoded as an array,
+and a `StreamString` is encoded as a string with content that is read as it is encoded.
+
+"""
+
+from json import JSONEncoder
+from json.encoder import encode_basestring_ascii
+
+
+class StreamString(object):
+    """A JSON string with content produced by calling `func(*args)`, which returns an iterable of chunks.
+
+    The function is called each time the string is encoded. Chunks are escaped, unless `raw` is
+    True, which should only be used for content that never needs escaping, such as base64.
+
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.raw = kwargs.pop('raw', False)
+
+    def __repr__(self):
+        return "<streamstring {!r}>".format(self.func)
+
+    def __iter__(self):
+        return iter(self.func(*self.args))
+
+
+class _Streamed(Exception):
+    """Raised when the json module encounters a value that must be streamed"""
+
+
+def _raise_streamed(obj):
+    raise _Streamed()
+
+
+# Encodes objects that contain no streamed values in one call to the (C accelerated) json module
+_encode = JSONEncoder(separators=(',', ':'), default=_raise_streamed).encode
+
+# Arrays are encoded this many items at a time, so a large array is never encoded in one piece
+_group_size = 256
+
+
+def _iter_groups(iterable):
+    group = []
+    for value in iterable:
+        group.append(value)
+        if len(group) >= _group_size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def _iterencode(obj):
+    if isinstance(obj, StreamString):
+        yield '"'
+        for chunk in obj:
+            yield chunk if obj.raw else encode_basestring_ascii(chunk)[1:-1]
+        yield '"'
+    elif isinstance(obj, dict):
+        yield '{'
+        for item_no, (key, value) in enumerate(obj.iteritems()):
+            if not isinstance(key, basestring):
+                key = _encode(key)
+            yield (',' if item_no else '') + encode_basestring_ascii(key) + ':'
+            for chunk in _iterencode(value):
+                yield chunk
+        yield '}'
+    elif hasattr(obj, '__iter__'):
+        yield '['
+        item_no = 0
+        for group in _iter_groups(obj):
+            try:
+                encoded = _encode(group)[1:-1]
+            except _Streamed:
+                for value in group:
+                    if item_no:
+                        yield ','
+                    for chunk in _iterencode(value):
+                        yield chunk
+                    item_no += 1
+            else:
+                yield (',' if item_no else '') + encoded
+                item_no += len(group)
+        yield ']'
+    else:
+        try:
+            yield _encode(obj)
+        except _Streamed:
+            raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+def iterencode(obj, chunk_size=64 * 1024):
+    """Encode an object as JSON, yielding chunks of roughly `chunk_size` bytes"""
+    buffer = []
+    buffer_size = 0
+    for chunk in _iterencode(obj):
+        buffer.append(chunk)
+        buffer_size += len(chunk)
+        if buffer_size >= chunk_size:
+            yield ''.join(buffer)
+            del buffer[:]
+            buffer_size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def dumps(obj):
+    """Encode an object as JSON, including streamed values"""
+    return ''.join(iterencode(obj))
@@ -1 +1,3 @@
-"""Unit tests go here"""
\ No newline at end of file
+# dataplicity.client and dataplicity.app import each other, and only resolve when the app is
+# imported first (as the dataplicity command does)
+import dataplicity.app
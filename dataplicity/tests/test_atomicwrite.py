@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+
+from dataplicity import atomicwrite
+
+
+class TestAtomicWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write(self):
+        path = os.path.join(self.path, 'test.txt')
+        with atomicwrite.open(path, 'wb') as f:
+            f.write('Hello')
+            self.assertFalse(os.path.exists(path))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'Hello')
+        self.assertEqual(os.listdir(self.path), ['test.txt'])
+
+    def test_concurrent_writes(self):
+        path = os.path.join(self.path, 'test.txt')
+        writers = []
+
+        def start_write(text):
+            writer = atomicwrite.open(path, 'wb')
+            writer.__enter__().write(text)
+            writers.append(writer)
+
+        # Both writes are in progress at once, in different threads
+        for text in ('first', 'second'):
+            thread = Thread(target=start_write, args=(text,))
+            thread.start()
+            thread.join()
+        for writer in writers:
+            writer.__exit__(None, None, None)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'second')
+        self.assertEqual(os.listdir(self.path), ['test.txt'])
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dataplicity.client.sampler import Sampler, CompressedSampler, RingSampler
+
+
+class TestCompressedSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _samples(self, start, stop):
+        return [(1400000000.0 + n * 10, 20.0 + (n % 5) * 0.5) for n in xrange(start, stop)]
+
+    def test_round_trip(self):
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        sampler.add_samples(self._samples(0, 25))
+        sampler.flush()
+        self.assertEqual(sampler.read_samples(), self._samples(0, 25))
+        sampler.close()
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        self.assertEqual(sampler.pending, 25)
+        self.assertEqual(sampler.read_samples(), self._samples(0, 25))
+
+    def test_snapshot(self):
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        for timestamp, value in self._samples(0, 30):
+            sampler.add_sample(timestamp, value)
+        sampler.flush()
+        self.assertEqual(sampler.snapshot_samples(), self._samples(0, 30))
+        sampler.remove_snapshot()
+        sampler.add_samples(self._samples(30, 35))
+        sampler.close()
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        self.assertEqual(sampler.read_samples(), self._samples(30, 35))
+
+    def test_truncated_block(self):
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        sampler.add_samples(self._samples(0, 10))
+        sampler.flush()
+        sampler.add_samples(self._samples(10, 20))
+        sampler.close()
+        with open(sampler.samples_path, 'r+b') as f:
+            f.seek(-3, os.SEEK_END)
+            f.truncate()
+        # The partial block is trimmed, so new blocks follow the last complete block
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        self.assertEqual(sampler.read_samples(), self._samples(0, 10))
+        sampler.add_samples(self._samples(20, 25))
+        sampler.close()
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=1000, flush_samples=10)
+        self.assertEqual(sampler.read_samples(), self._samples(0, 10) + self._samples(20, 25))
+
+    def test_conversion(self):
+        sampler = Sampler(self.path, 'temperature', max_samples=100)
+        sampler.add_samples(self._samples(0, 5))
+        sampler.snapshot_samples(max_samples=2)
+        sampler.remove_snapshot()
+        sampler.close()
+        # Only samples which weren't acknowledged are converted
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=100)
+        self.assertEqual(sampler.read_samples(), self._samples(2, 5))
+        sampler.add_samples(self._samples(5, 7))
+        sampler.close()
+        sampler = RingSampler(self.path, 'temperature', max_samples=100)
+        self.assertEqual(sampler.read_samples(), self._samples(2, 7))
+        sampler.add_samples(self._samples(7, 9))
+        sampler.close()
+        sampler = Sampler(self.path, 'temperature', max_samples=100)
+        self.assertEqual(sampler.read_samples(), self._samples(2, 9))
+        sampler.add_samples(self._samples(9, 10))
+        sampler.close()
+        sampler = CompressedSampler(self.path, 'temperature', max_samples=100)
+        self.assertEqual(sampler.read_samples(), self._samples(2, 10))
+        self.assertEqual(sorted(os.listdir(self.path)), ['samples.cursor', 'samples.idx', 'samples.smp'])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dataplicity.client import eventcodecs
+from dataplicity.client.eventcodecs import CodecError, pack, unpack
+
+
+class TestMsgPack(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [None, True, False,
+                  0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32, 2 ** 63 - 1, 2 ** 64 - 1,
+                  -1, -32, -33, -128, -129, -2 ** 31, -2 ** 63,
+                  0.0, -1.5, 1e300, float('inf'),
+                  u'', u'text', u'événement', u'x' * 31, u'x' * 32, u'x' * 300, u'x' * 70000,
+                  [], [1, [2, [3]]], range(20), range(70000),
+                  {}, {u'a': 1, u'b': {u'c': [None, u'd']}},
+                  dict((unicode(n), n) for n in xrange(20))]
+        for value in values:
+            self.assertEqual(unpack(pack(value)), value)
+
+    def test_encoding(self):
+        # Check against the MessagePack specification, so other implementations can read records
+        self.assertEqual(pack(None), b'\xc0')
+        self.assertEqual(pack(5), b'\x05')
+        self.assertEqual(pack(-1), b'\xff')
+        self.assertEqual(pack(2 ** 64 - 1), b'\xcf' + b'\xff' * 8)
+        self.assertEqual(pack(1.5), b'\xcb\x3f\xf8' + b'\0' * 6)
+        self.assertEqual(pack('abc'), b'\xa3abc')
+        self.assertEqual(pack([1, 2]), b'\x92\x01\x02')
+        self.assertEqual(pack({'a': None}), b'\x81\xa1a\xc0')
+        self.assertEqual(pack((1,)), pack([1]))
+        self.assertEqual(unpack(b'\xcc\xff'), 255)
+        self.assertEqual(unpack(b'\xd1\xff\x00'), -256)
+        self.assertEqual(unpack(b'\xc4\x02ab'), b'ab')
+        self.assertEqual(unpack(b'\xd9\x02\xc3\xa9'), u'é')
+
+    def test_unencodable(self):
+        self.assertRaises(CodecError, pack, 2 ** 64)
+        self.assertRaises(CodecError, pack, -2 ** 63 - 1)
+        self.assertRaises(CodecError, pack, object())
+
+    def test_truncated(self):
+        data = pack({u'values': [1.5, u'text', 2 ** 40]})
+        for size in xrange(len(data)):
+            self.assertRaises(CodecError, unpack, data[:size])
+
+    def test_corrupt(self):
+        self.assertRaises(CodecError, unpack, b'\xc1')
+        self.assertRaises(CodecError, unpack, b'\xa2\xff\xfe')
+        self.assertRaises(CodecError, unpack, pack(1) + b'\x00')
+
+
+class TestRecords(unittest.TestCase):
+
+    event = {u'event_id': u'abc', u'type': u'TEXT', u'timestamp': 1400000000.25,
+             u'text': u'événement', u'attachments': [{u'filename': u'a.jpg', u'size': 1024}],
+             u'hidden': False}
+
+    def test_codecs(self):
+        self.assertEqual(eventcodecs.get_codec_names(), ['json', 'msgpack', 'zlib'])
+        for name in eventcodecs.get_codec_names():
+            codec = eventcodecs.get_codec(name)
+            record = eventcodecs.encode_record(codec, self.event)
+            self.assertEqual(record[:1], codec.codec_id)
+            self.assertEqual(eventcodecs.decode_record(record), self.event)
+
+    def test_legacy_json(self):
+        self.assertEqual(eventcodecs.decode_record(b'{"text": "legacy"}'), {u'text': u'legacy'})
+
+    def test_unknown(self):
+        self.assertRaises(CodecError, eventcodecs.get_codec, 'xml')
+        self.assertRaises(CodecError, eventcodecs.decode_record, b'?data')
+
+    def test_truncated_record(self):
+        codec = eventcodecs.get_codec('msgpack')
+        record = eventcodecs.encode_record(codec, self.event)
+        # The msgpack module, if installed, raises ValueError subclasses
+        self.assertRaises((ValueError, CodecError), eventcodecs.decode_record, record[:-1])
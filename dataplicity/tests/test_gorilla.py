@@ -0,0 +1,76 @@
+import math
+import unittest
+
+from dataplicity.client import gorilla
+
+
+class TestGorilla(unittest.TestCase):
+
+    def _round_trip(self, flat):
+        block = gorilla.encode_block(flat)
+        blocks = list(gorilla.iter_blocks(block))
+        self.assertEqual(len(blocks), 1)
+        _offset, size, count, payload = blocks[0]
+        self.assertEqual((size, count), (len(block), len(flat) // 2))
+        return gorilla.decode_payload(payload, count)
+
+    def test_regular_samples(self):
+        flat = []
+        for n in xrange(1000):
+            flat.extend([1400000000.0 + n * 5, 20.0 + (n % 7) * 0.25])
+        self.assertEqual(self._round_trip(flat), flat)
+        # Regular timestamps and slowly changing values compress well
+        self.assertTrue(len(gorilla.encode_block(flat)) < len(flat) * 8 / 4)
+
+    def test_edge_values(self):
+        flat = [0.0, 0.0,
+                0.000001, -0.0,
+                1.5, 1e308,
+                1.5, 1e308,
+                -86400.0, -1e-308,
+                4000000000.0, float('inf'),
+                4000000000.25, float('-inf'),
+                4000000001.0, 123456.789]
+        self.assertEqual(self._round_trip(flat), flat)
+        self.assertEqual(math.copysign(1.0, self._round_trip(flat)[3]), -1.0)
+
+    def test_nan(self):
+        decoded = self._round_trip([1.0, float('nan'), 2.0, 3.0, 3.0, float('nan')])
+        self.assertTrue(math.isnan(decoded[1]))
+        self.assertEqual(decoded[2:4], [2.0, 3.0])
+        self.assertTrue(math.isnan(decoded[5]))
+
+    def test_delta_buckets(self):
+        # Deltas of delta that fit each bucket, and the 64 bit escape
+        timestamp = 1000.0
+        flat = [timestamp, 1.0]
+        for step in (0, 0.00005, 0.0002, 0.002, 0.5, 100000.0, -0.000001, 0.000001):
+            timestamp += step
+            flat.extend([round(timestamp, 6), 1.0])
+        self.assertEqual(self._round_trip(flat), flat)
+
+    def test_single_and_empty(self):
+        self.assertEqual(self._round_trip([5.0, 6.0]), [5.0, 6.0])
+        self.assertEqual(self._round_trip([]), [])
+
+    def test_consecutive_blocks(self):
+        first = [1.0, 1.0, 2.0, 2.0]
+        second = [3.0, 3.0]
+        data = gorilla.encode_block(first) + gorilla.encode_block(second)
+        self.assertEqual(gorilla.decode_blocks(data), first + second)
+
+    def test_truncated_block(self):
+        first = [1.0, 1.0, 2.0, 2.0]
+        data = gorilla.encode_block(first) + gorilla.encode_block([3.0, 3.0, 4.0, 5.0])
+        # An interrupted write leaves a partial block, which is ignored
+        for size in xrange(len(data) - 1, len(data) - 12, -1):
+            self.assertEqual(gorilla.decode_blocks(data[:size]), first)
+        self.assertEqual(gorilla.decode_blocks(data[:3]), [])
+
+    def test_corrupt_payload(self):
+        block = gorilla.encode_block([1.0, 1.0, 2.0, 2.5, 3.0, 7.0])
+        _offset, _size, count, payload = next(gorilla.iter_blocks(block))
+        with self.assertRaises(gorilla.GorillaError):
+            gorilla.decode_payload(payload[:10], count)
+        with self.assertRaises(gorilla.GorillaError):
+            gorilla.decode_payload(payload, count + 100)
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dataplicity.client.sampler import Sampler, RingSampler
+
+
+class TestRingSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _samples(self, start, stop):
+        return [(float(n), n * 0.5) for n in xrange(start, stop)]
+
+    def test_round_trip(self):
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        sampler.add_samples(self._samples(0, 4))
+        self.assertEqual(sampler.pending, 4)
+        self.assertEqual(sampler.read_samples(), self._samples(0, 4))
+        sampler.close()
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        self.assertEqual(sampler.read_samples(), self._samples(0, 4))
+
+    def test_wraparound(self):
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        for timestamp, value in self._samples(0, 25):
+            sampler.add_sample(timestamp, value)
+        # The oldest samples are overwritten
+        self.assertTrue(sampler.full)
+        self.assertEqual(sampler.read_samples(), self._samples(15, 25))
+        self.assertEqual(sampler.snapshot_samples(max_samples=4), self._samples(15, 19))
+        sampler.remove_snapshot()
+        self.assertEqual(sampler.pending, 6)
+        sampler.close()
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        self.assertEqual(sampler.read_samples(), self._samples(19, 25))
+
+    def test_resize(self):
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        for timestamp, value in self._samples(0, 15):
+            sampler.add_sample(timestamp, value)
+        sampler.close()
+        # Samples are kept when the ring grows, and the newest are kept when it shrinks
+        sampler = RingSampler(self.path, 'temperature', max_samples=20)
+        self.assertEqual(sampler.read_samples(), self._samples(5, 15))
+        sampler.close()
+        sampler = RingSampler(self.path, 'temperature', max_samples=4)
+        self.assertEqual(sampler.read_samples(), self._samples(11, 15))
+
+    def test_damaged_ring(self):
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        sampler.add_samples(self._samples(0, 4))
+        sampler.close()
+        ring_path = os.path.join(self.path, 'samples.ring')
+        with open(ring_path, 'r+b') as f:
+            f.truncate(len(sampler.header) + 3)
+        # A damaged ring is replaced with an empty one
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        self.assertEqual(sampler.read_samples(), [])
+        sampler.add_samples(self._samples(4, 6))
+        self.assertEqual(sampler.read_samples(), self._samples(4, 6))
+
+    def test_migrate_to_file(self):
+        sampler = RingSampler(self.path, 'temperature', max_samples=10)
+        for timestamp, value in self._samples(0, 12):
+            sampler.add_sample(timestamp, value)
+        sampler.close()
+        sampler = Sampler(self.path, 'temperature', max_samples=100)
+        self.assertEqual(sampler.read_samples(), self._samples(2, 12))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'samples.ring')))
+        sampler.add_sample(12.0, 6.0)
+        sampler.close()
+        sampler = Sampler(self.path, 'temperature', max_samples=100)
+        self.assertEqual(sampler.read_samples(), self._samples(2, 13))
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dataplicity.client.sampler import SegmentStore, SegmentSampler
+
+
+class TestSegmentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = SegmentStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def _segments(self):
+        return sorted(filename for filename in os.listdir(self.path) if filename.endswith('.seg'))
+
+    def test_round_trip(self):
+        temperature = SegmentSampler(self.store, 'temperature', max_samples=100)
+        humidity = SegmentSampler(self.store, 'humidity', max_samples=100)
+        for n in xrange(10):
+            temperature.add_sample(float(n), n * 1.5)
+            humidity.add_sample(float(n), -n)
+        self.assertEqual(temperature.pending, 10)
+        self.assertEqual(temperature.read_samples(), [(float(n), n * 1.5) for n in xrange(10)])
+        self.assertEqual(humidity.snapshot_samples(), [(float(n), float(-n)) for n in xrange(10)])
+
+    def test_reopen(self):
+        sampler = SegmentSampler(self.store, 'temperature', max_samples=100)
+        sampler.add_samples([(1.0, 2.0), (3.0, 4.0)])
+        self.store.close()
+        self.store = SegmentStore(self.path)
+        sampler = SegmentSampler(self.store, 'temperature', max_samples=100)
+        self.assertEqual(sampler.pending, 2)
+        self.assertEqual(sampler.read_samples(), [(1.0, 2.0), (3.0, 4.0)])
+
+    def test_truncated_record(self):
+        sampler = SegmentSampler(self.store, 'temperature', max_samples=100)
+        sampler.add_samples([(1.0, 2.0), (3.0, 4.0)])
+        self.store.close()
+        segment_path = os.path.join(self.path, self._segments()[-1])
+        with open(segment_path, 'r+b') as f:
+            f.seek(-5, os.SEEK_END)
+            f.truncate()
+        self.store = SegmentStore(self.path)
+        sampler = SegmentSampler(self.store, 'temperature', max_samples=100)
+        self.assertEqual(sampler.pending, 1)
+        self.assertEqual(sampler.snapshot_samples(), [(1.0, 2.0)])
+
+    def test_lazy_snapshot(self):
+        self.store.read_records = 3
+        temperature = SegmentSampler(self.store, 'temperature', max_samples=1000)
+        humidity = SegmentSampler(self.store, 'humidity', max_samples=1000)
+        for n in xrange(20):
+            temperature.add_sample(float(n), 1.0)
+            humidity.add_sample(float(n), 2.0)
+        samples = temperature.snapshot_samples(max_samples=15, lazy=True)
+        self.assertFalse(isinstance(samples, list))
+        self.assertEqual(list(samples), [(float(n), 1.0) for n in xrange(15)])
+        temperature.remove_snapshot()
+        self.assertEqual(temperature.pending, 5)
+        self.assertEqual(list(temperature.snapshot_samples(lazy=True)),
+                         [(float(n), 1.0) for n in xrange(15, 20)])
+        self.assertEqual(humidity.snapshot_samples(max_samples=0), [])
+
+    def test_ack_and_commit(self):
+        temperature = SegmentSampler(self.store, 'temperature', max_samples=100)
+        humidity = SegmentSampler(self.store, 'humidity', max_samples=100)
+        temperature.add_samples([(1.0, 1.0), (2.0, 2.0)])
+        humidity.add_samples([(1.0, 1.0)])
+        self.assertEqual(len(temperature.snapshot_samples()), 2)
+        temperature.remove_snapshot()
+        self.store.commit()
+        # The segment is kept until every series in it is acknowledged
+        self.assertEqual(len(self._segments()), 2)
+        self.assertEqual(humidity.snapshot_samples(), [(1.0, 1.0)])
+        humidity.remove_snapshot()
+        self.store.commit()
+        self.assertEqual(len(self._segments()), 1)
+        self.assertEqual((temperature.pending, humidity.pending), (0, 0))
+
+        # Acknowledgements survive a restart
+        self.store.close()
+        self.store = SegmentStore(self.path)
+        temperature = SegmentSampler(self.store, 'temperature', max_samples=100)
+        self.assertEqual(temperature.snapshot_samples(), [])
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+
+from dataplicity.client.timeline import Timeline
+
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _open(self, **kwargs):
+        return Timeline(os.path.join(self.path, 'events'), 'events', **kwargs)
+
+    def _add(self, timeline, text):
+        with timeline.new_event('TEXT', text=text, title=text) as event:
+            pass
+        return event.event_id
+
+    def _texts(self, timeline):
+        return sorted(event['text'] for event in timeline.get_events())
+
+    def _segments(self):
+        return sorted(filename for filename in os.listdir(os.path.join(self.path, 'events'))
+                      if filename.endswith('.log'))
+
+    def test_round_trip(self):
+        timeline = self._open()
+        for text in ('one', 'two', 'three'):
+            self._add(timeline, text)
+        self.assertEqual(self._texts(timeline), ['one', 'three', 'two'])
+        timeline.close()
+        timeline = self._open()
+        self.assertEqual(self._texts(timeline), ['one', 'three', 'two'])
+        self.assertEqual(len(timeline), 3)
+
+    def test_truncated_record(self):
+        timeline = self._open()
+        self._add(timeline, 'one')
+        self._add(timeline, 'two')
+        timeline.close()
+        segment_path = os.path.join(self.path, 'events', self._segments()[-1])
+        with open(segment_path, 'r+b') as f:
+            f.seek(-3, os.SEEK_END)
+            f.truncate()
+        timeline = self._open()
+        self.assertEqual(self._texts(timeline), ['one'])
+        # New events go in a new segment, after the partial record
+        self._add(timeline, 'three')
+        timeline.close()
+        self.assertEqual(self._texts(self._open()), ['one', 'three'])
+
+    def test_two_writers(self):
+        # The daemon's timeline, and another process (e.g. the dataplicity event command)
+        daemon = self._open(segment_size=1)
+        command = self._open()
+        self._add(daemon, 'daemon 1')
+        self._add(command, 'command')
+        # Rotating must not append to the segment the command created
+        self._add(daemon, 'daemon 2')
+        self.assertEqual(len(self._segments()), 3)
+        self.assertEqual(self._texts(daemon), ['command', 'daemon 1', 'daemon 2'])
+        seqs = [entry[0] for entry in daemon._index.values()]
+        self.assertEqual(len(set(seqs)), 3)
+
+        command.close()
+        daemon.close()
+        self.assertEqual(self._texts(self._open()), ['command', 'daemon 1', 'daemon 2'])
+
+    def test_acks_round_trip(self):
+        timeline = self._open()
+        event_ids = [self._add(timeline, str(n)) for n in xrange(20)]
+        # Acknowledge out of order, so the acks have a watermark and a bitmap
+        acked = set(event_ids[:3] + event_ids[5:6] + event_ids[11:17:2])
+        timeline.clear_events(acked)
+        timeline.close()
+        timeline = self._open()
+        self.assertEqual(self._texts(timeline),
+                         sorted(str(n) for n, event_id in enumerate(event_ids) if event_id not in acked))
+        self.assertEqual(timeline._acks.values(), [[3, set([5, 11, 13, 15])]])
+
+    def test_damaged_acks(self):
+        timeline = self._open()
+        event_ids = [self._add(timeline, str(n)) for n in xrange(3)]
+        timeline.clear_events(event_ids[:1])
+        timeline.close()
+        acks_path = os.path.join(self.path, 'events', 'acks.bin')
+        with open(acks_path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.truncate()
+        # A truncated ack record is ignored, at worst events are synced again
+        self.assertEqual(self._texts(self._open()), ['0', '1', '2'])
+        with open(acks_path, 'wb') as f:
+            f.write('not acks\n')
+        self.assertEqual(self._texts(self._open()), ['0', '1', '2'])
+
+    def test_reclaim(self):
+        timeline = self._open(segment_size=1)
+        with timeline.new_event('TEXT', text='photo', title='photo') as event:
+            event.attach_bytes('x' * 100, filename='photo.bin')
+        self._add(timeline, 'text')
+        blobs_path = os.path.join(self.path, 'events', 'blobs')
+        self.assertEqual(len(os.listdir(blobs_path)), 1)
+        self.assertEqual(len(self._segments()), 2)
+        photo_id = [event['event_id'] for event in timeline.get_events() if event['text'] == 'photo']
+        timeline.clear_events(photo_id)
+        timeline.reclaim()
+        self.assertEqual(os.listdir(blobs_path), [])
+        self.assertEqual(len(self._segments()), 1)
+        timeline.close()
+        self.assertEqual(self._texts(self._open()), ['text'])
+
+    def test_reclaim_keeps_rewritten_blob(self):
+        timeline = self._open()
+        with timeline.new_event('TEXT', text='one', title='one') as event:
+            event.attach_bytes('same data', filename='a.bin')
+        timeline.clear_events([event['event_id'] for event in timeline.get_events()])
+        # The same attachment is written again before the blob is reclaimed
+        with timeline.new_event('TEXT', text='two', title='two') as event:
+            event.attach_bytes('same data', filename='a.bin')
+        timeline.reclaim()
+        events = timeline.get_events()
+        self.assertEqual([event['text'] for event in events], ['two'])
+        self.assertEqual(len(os.listdir(os.path.join(self.path, 'events', 'blobs'))), 1)
+
+    def test_concurrent_reclaim(self):
+        first = self._open(segment_size=1)
+        second = self._open(segment_size=1)
+        event_ids = [self._add(first, str(n)) for n in xrange(4)]
+        second.get_events()
+        for timeline in (first, second):
+            timeline.clear_events(event_ids)
+        threads = [Thread(target=timeline.reclaim) for timeline in (first, second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        first.close()
+        second.close()
+        self.assertEqual(self._texts(self._open()), [])
+        self.assertEqual(self._segments(), [])